@@ -0,0 +1,27 @@
+"""
+Access control for routes that show data across users.
+
+Only the users named in ADMIN_USERS (comma-separated usernames) can reach
+them. Nobody is an admin unless it is set.
+"""
+
+import os
+from functools import wraps
+from flask import jsonify
+from flask_login import current_user
+
+ADMIN_USERS = {name.strip() for name in os.getenv('ADMIN_USERS', '').split(',') if name.strip()}
+
+
+def is_admin(user):
+    return user.is_authenticated and user.username in ADMIN_USERS
+
+
+def admin_required(view):
+    """Reject non-admins with a 403. Apply it below @login_required."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_admin(current_user):
+            return jsonify({'error': 'Unauthorized'}), 403
+        return view(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,255 @@
+"""
+Precomputed emergency analytics.
+
+Rollup tables are updated in the same transaction as the EmergencyHistory
+write, so dashboards read small aggregates instead of scanning the history:
+
+    emergency_user_daily   - emergencies per user per day, and time-to-resolve
+    emergency_cell_hourly  - emergencies per geohash cell per hour (heatmaps)
+    emergency_resolution   - emergencies already counted as resolved, so a
+                             reopened one isn't counted twice
+
+Counts can be rebuilt from emergency_history with the compaction job:
+
+    python analytics.py --db women_safety.db --compact
+"""
+
+import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import MetaData, Table, Column, Integer, Float, String, DateTime, create_engine, select, func, text
+from sqlalchemy.dialects.sqlite import insert
+
+# Precision 5 cells are about 4.9km x 4.9km
+GEOHASH_PRECISION = 5
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+metadata = MetaData()
+
+user_daily = Table(
+    'emergency_user_daily', metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('day', String(10), primary_key=True),  # YYYY-MM-DD (UTC)
+    Column('count', Integer, nullable=False, default=0),
+    Column('resolved_count', Integer, nullable=False, default=0),
+    Column('resolve_seconds', Float, nullable=False, default=0.0)
+)
+
+cell_hourly = Table(
+    'emergency_cell_hourly', metadata,
+    Column('cell', String(12), primary_key=True),
+    Column('hour', String(13), primary_key=True),  # YYYY-MM-DDTHH (UTC)
+    Column('count', Integer, nullable=False, default=0)
+)
+
+# An emergency is identified by its owner and the time it was raised
+resolutions = Table(
+    'emergency_resolution', metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('raised_at', DateTime, primary_key=True),
+    Column('resolved_at', DateTime)
+)
+
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Encode a position as a geohash string"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        value, bounds = (longitude, lon_range) if even else (latitude, lat_range)
+        mid = (bounds[0] + bounds[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            bounds[0] = mid
+        else:
+            bits <<= 1
+            bounds[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits, bit_count = 0, 0
+    return ''.join(chars)
+
+
+def is_geohash(value):
+    return all(char in _BASE32 for char in value)
+
+
+def geohash_center(cell):
+    """Return the (latitude, longitude) at the centre of a geohash cell"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in cell:
+        value = _BASE32.index(char)
+        for shift in range(4, -1, -1):
+            bounds = lon_range if even else lat_range
+            mid = (bounds[0] + bounds[1]) / 2
+            if value >> shift & 1:
+                bounds[0] = mid
+            else:
+                bounds[1] = mid
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+
+def create_tables(engine):
+    metadata.create_all(engine)
+
+
+def _day(timestamp):
+    return timestamp.strftime('%Y-%m-%d')
+
+
+def _hour(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H')
+
+
+def record_emergency(session, user_id, latitude, longitude, timestamp=None):
+    """
+    Add one emergency to the rollups. Call it before committing the
+    EmergencyHistory row so both land in the same transaction.
+    """
+    timestamp = timestamp or datetime.utcnow()
+
+    stmt = insert(user_daily).values(user_id=user_id, day=_day(timestamp), count=1)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'day'],
+        set_={'count': user_daily.c.count + 1}
+    ))
+
+    stmt = insert(cell_hourly).values(
+        cell=geohash_encode(latitude, longitude), hour=_hour(timestamp), count=1
+    )
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=['cell', 'hour'],
+        set_={'count': cell_hourly.c.count + 1}
+    ))
+
+
+def record_resolution(session, user_id, created_at, resolved_at=None):
+    """
+    Add a resolved emergency's time-to-resolve to the day it was raised.
+    Only the first resolution counts; resolving it again after reopening is ignored.
+
+    Returns:
+    bool: True if the resolution was counted
+    """
+    resolved_at = resolved_at or datetime.utcnow()
+    seconds = max(0.0, (resolved_at - created_at).total_seconds())
+
+    first = session.execute(insert(resolutions).values(
+        user_id=user_id, raised_at=created_at, resolved_at=resolved_at
+    ).on_conflict_do_nothing())
+    if not first.rowcount:
+        return False
+
+    stmt = insert(user_daily).values(
+        user_id=user_id, day=_day(created_at), count=0, resolved_count=1, resolve_seconds=seconds
+    )
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'day'],
+        set_={
+            'resolved_count': user_daily.c.resolved_count + 1,
+            'resolve_seconds': user_daily.c.resolve_seconds + seconds
+        }
+    ))
+    return True
+
+
+def user_trend(conn, user_id, days=30):
+    """
+    Daily emergency counts and mean time-to-resolve for one user
+
+    Returns:
+    list: One dict per day that had activity, oldest first
+    """
+    since = _day(datetime.utcnow() - timedelta(days=days - 1))
+    rows = conn.execute(
+        select(user_daily)
+        .where(user_daily.c.user_id == user_id, user_daily.c.day >= since)
+        .order_by(user_daily.c.day)
+    )
+    return [{
+        'day': row.day,
+        'count': row.count,
+        'resolved': row.resolved_count,
+        'avg_resolve_seconds': round(row.resolve_seconds / row.resolved_count, 1) if row.resolved_count else None
+    } for row in rows]
+
+
+def heatmap_tile(conn, tile='', hours=24):
+    """
+    Emergency counts per cell inside a geohash tile over the last `hours`
+
+    Parameters:
+    tile (str): Geohash prefix selecting the tile ('' for everywhere)
+    hours (int): How far back to look
+
+    Returns:
+    list: One dict per cell with its centre position and count
+    """
+    since = _hour(datetime.utcnow() - timedelta(hours=hours - 1))
+    rows = conn.execute(
+        select(cell_hourly.c.cell, func.sum(cell_hourly.c.count).label('count'))
+        .where(cell_hourly.c.cell.like(f"{tile}%"), cell_hourly.c.hour >= since)
+        .group_by(cell_hourly.c.cell)
+    )
+    cells = []
+    for row in rows:
+        latitude, longitude = geohash_center(row.cell)
+        cells.append({'cell': row.cell, 'latitude': latitude, 'longitude': longitude, 'count': row.count})
+    return cells
+
+
+def compact(engine):
+    """
+    Rebuild the emergency counts from emergency_history.
+
+    Time-to-resolve is only known when the status changes, so the
+    resolved_count and resolve_seconds columns are kept as they are.
+    Emergencies that are resolved now are marked as counted.
+    """
+    create_tables(engine)
+    with engine.begin() as conn:
+        daily, hourly = {}, {}
+        rows = conn.execute(text("SELECT user_id, latitude, longitude, timestamp FROM emergency_history"))
+        for user_id, latitude, longitude, timestamp in rows:
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp)
+            daily[(user_id, _day(timestamp))] = daily.get((user_id, _day(timestamp)), 0) + 1
+            key = (geohash_encode(latitude, longitude), _hour(timestamp))
+            hourly[key] = hourly.get(key, 0) + 1
+
+        conn.execute(user_daily.update().values(count=0))
+        for (user_id, day), count in daily.items():
+            conn.execute(insert(user_daily).values(user_id=user_id, day=day, count=count).on_conflict_do_update(
+                index_elements=['user_id', 'day'], set_={'count': count}
+            ))
+
+        resolved = conn.execute(text("SELECT user_id, timestamp FROM emergency_history WHERE status = 'resolved'"))
+        for user_id, timestamp in resolved:
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp)
+            conn.execute(insert(resolutions).values(user_id=user_id, raised_at=timestamp).on_conflict_do_nothing())
+
+        conn.execute(cell_hourly.delete())
+        if hourly:
+            conn.execute(cell_hourly.insert(), [
+                {'cell': cell, 'hour': hour, 'count': count} for (cell, hour), count in hourly.items()
+            ])
+
+    print(f"Compacted {sum(daily.values())} emergencies into {len(daily)} daily and {len(hourly)} hourly rollups")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Maintain the emergency analytics rollups")
+    parser.add_argument("--db", default="women_safety.db", help="SQLite database file")
+    parser.add_argument("--compact", action="store_true", help="Rebuild rollup counts from emergency_history")
+    args = parser.parse_args()
+
+    engine = create_engine(f"sqlite:///{args.db}")
+    if args.compact:
+        compact(engine)
+    else:
+        create_tables(engine)
+        print("Rollup tables are in place. Use --compact to rebuild them from emergency_history.")
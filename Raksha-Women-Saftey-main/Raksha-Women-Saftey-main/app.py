@@ -1,16 +1,28 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, g, has_request_context
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
+import time
+import asyncio
 from datetime import datetime
-from geopy.geocoders import Nominatim
 from geopy.distance import geodesic
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
 import json
 from dotenv import load_dotenv
 import requests
 from twilio.rest import Client
 from data import send_emergency_alerts
+import analytics
+import page_cache
+import group_commit
+import geocoding
+import sharding
+from profiling import init_profiling
+from rate_limit import rate_limited
+from admin import admin_required
+from provider_health import send_with_failover, health_report
 
 # Load environment variables
 load_dotenv()
@@ -18,6 +30,8 @@ load_dotenv()
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-here')
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///women_safety.db'
+# Extra databases for per-user rows when SHARD_COUNT > 1 (see sharding.py)
+app.config['SQLALCHEMY_BINDS'] = sharding.shard_binds()
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['GOOGLE_MAPS_API_KEY'] = os.getenv('GOOGLE_MAPS_API_KEY')
@@ -27,11 +41,14 @@ twilio_account_sid = os.getenv('TWILIO_ACCOUNT_SID')
 twilio_auth_token = os.getenv('TWILIO_AUTH_TOKEN')
 twilio_client = Client(twilio_account_sid, twilio_auth_token)
 
-db = SQLAlchemy(app)
+db = sharding.ShardedSQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# Opt-in request profiling (see profiling.py)
+init_profiling(app)
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -83,10 +100,97 @@ class Location(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+class SyncCursor(db.Model):
+    # Highest event sequence number applied from each of a user's devices (see /api/sync)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    device = db.Column(db.String(64), nullable=False)
+    seq = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint('user_id', 'device'),)
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+# Per-request timing and query count, reported in the Server-Timing header
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def add_server_timing(response):
+    if 'request_started' in g:
+        elapsed = (time.perf_counter() - g.request_started) * 1000
+        response.headers['Server-Timing'] = (
+            f'app;dur={elapsed:.1f}, db;desc="{g.get("query_count", 0)} queries"'
+        )
+    return response
+
+def contact_to_dict(contact):
+    return {
+        'id': contact.id,
+        'name': contact.name,
+        'phone': contact.phone,
+        'relationship': contact.relationship
+    }
+
+def zone_to_dict(zone):
+    return {
+        'id': zone.id,
+        'name': zone.name,
+        'latitude': zone.latitude,
+        'longitude': zone.longitude,
+        'radius': zone.radius,
+        'description': zone.description
+    }
+
+def emergency_to_dict(emergency):
+    return {
+        'id': emergency.id,
+        'timestamp': emergency.timestamp.isoformat(),
+        'latitude': emergency.latitude,
+        'longitude': emergency.longitude,
+        'location_name': emergency.location_name,
+        'status': emergency.status,
+        'description': emergency.description
+    }
+
+def cached_contacts(user_id):
+    return page_cache.cached('contacts', user_id, ['contacts'], lambda: [
+        contact_to_dict(contact) for contact in Contact.query.filter_by(user_id=user_id).all()
+    ])
+
+def cached_zones(user_id):
+    return page_cache.cached('zones', user_id, ['zones'], lambda: [
+        zone_to_dict(zone) for zone in SafetyZone.query.filter_by(user_id=user_id).all()
+    ])
+
+def recent_emergencies(user_id, limit=5):
+    return EmergencyHistory.query.filter_by(user_id=user_id) \
+        .order_by(EmergencyHistory.timestamp.desc()).limit(limit).all()
+
+def emergency_summary(user_id):
+    return page_cache.cached('emergency-summary', user_id, ['emergencies'], lambda: {
+        'count': EmergencyHistory.query.filter_by(user_id=user_id).count(),
+        'recent': [emergency_to_dict(emergency) for emergency in recent_emergencies(user_id)]
+    })
+
+def dashboard_data(user_id):
+    """Everything the dashboard shows, built from the per-user caches"""
+    emergencies = emergency_summary(user_id)
+    return {
+        'contacts': cached_contacts(user_id),
+        'zones': cached_zones(user_id),
+        'emergency_count': emergencies['count'],
+        'recent_emergencies': emergencies['recent']
+    }
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -134,9 +238,25 @@ def login():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    contacts = Contact.query.filter_by(user_id=current_user.id).all()
-    zones = SafetyZone.query.filter_by(user_id=current_user.id).all()
-    return render_template('dashboard.html', contacts=contacts, zones=zones)
+    user_id = current_user.id
+    data = dashboard_data(user_id)
+    contacts_html = page_cache.cached('fragment:dashboard-contacts', user_id, ['contacts'], lambda: render_template(
+        'partials/dashboard_contacts.html', contacts=data['contacts']
+    ))
+    recent_emergencies_html = page_cache.cached('fragment:recent-emergencies', user_id, ['emergencies'], lambda: render_template(
+        'partials/recent_emergencies.html', recent_emergencies=recent_emergencies(user_id)
+    ))
+    return render_template(
+        'dashboard.html',
+        dashboard=data,
+        contacts_html=contacts_html,
+        recent_emergencies_html=recent_emergencies_html
+    )
+
+@app.route('/api/dashboard', methods=['GET'])
+@login_required
+def get_dashboard():
+    return jsonify(dashboard_data(current_user.id))
 
 @app.route('/safety-zones', methods=['GET', 'POST'])
 @login_required
@@ -153,6 +273,7 @@ def manage_safety_zones():
         )
         db.session.add(zone)
         db.session.commit()
+        page_cache.bump('zones', current_user.id)
         return jsonify({'message': 'Safety zone added successfully'})
     
     zones = SafetyZone.query.filter_by(user_id=current_user.id).all()
@@ -161,15 +282,18 @@ def manage_safety_zones():
 @app.route('/api/safety-zones', methods=['GET'])
 @login_required
 def get_safety_zones():
-    zones = SafetyZone.query.filter_by(user_id=current_user.id).all()
-    return jsonify([{
-        'id': zone.id,
-        'name': zone.name,
-        'latitude': zone.latitude,
-        'longitude': zone.longitude,
-        'radius': zone.radius,
-        'description': zone.description
-    } for zone in zones])
+    return jsonify(cached_zones(current_user.id))
+
+@app.route('/api/zone-status', methods=['GET'])
+@login_required
+def get_zone_status():
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lng', type=float)
+    if latitude is None or longitude is None:
+        return jsonify({'error': 'lat and lng are required'}), 400
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return jsonify({'error': 'lat or lng is out of range'}), 400
+    return jsonify(zone_status(current_user.id, latitude, longitude))
 
 @app.route('/api/safety-zones', methods=['POST'])
 @login_required
@@ -190,6 +314,7 @@ def add_safety_zone():
         )
         db.session.add(zone)
         db.session.commit()
+        page_cache.bump('zones', current_user.id)
         
         return jsonify({
             'message': 'Safety zone added successfully',
@@ -229,6 +354,7 @@ def update_safety_zone(zone_id):
             zone.description = data['description']
             
         db.session.commit()
+        page_cache.bump('zones', current_user.id)
         
         return jsonify({
             'message': 'Safety zone updated successfully',
@@ -256,6 +382,7 @@ def delete_safety_zone(zone_id):
     try:
         db.session.delete(zone)
         db.session.commit()
+        page_cache.bump('zones', current_user.id)
         return jsonify({'message': 'Safety zone deleted successfully'})
     except Exception as e:
         db.session.rollback()
@@ -263,6 +390,7 @@ def delete_safety_zone(zone_id):
 
 @app.route('/share-location', methods=['POST'])
 @login_required
+@rate_limited('share-location', per_user=(5, 60), per_route=(20, 1))
 def share_location():
     try:
         data = request.get_json()
@@ -272,20 +400,22 @@ def share_location():
         if not latitude or not longitude:
             return jsonify({'error': 'Location data not provided'}), 400
 
-        # Get location name using geopy
-        geolocator = Nominatim(user_agent="women_safety_app")
-        location = geolocator.reverse(f"{latitude}, {longitude}")
-        location_name = location.address if location else "Unknown Location"
+        # Get location name; SOS lookups take precedence over shares
+        location_name = reverse_geocode(latitude, longitude, priority='share')
 
         # Create location record
-        new_location = Location(
-            latitude=latitude,
-            longitude=longitude,
-            address=location_name,
-            user_id=current_user.id
-        )
-        db.session.add(new_location)
-        db.session.commit()
+        location_row = {
+            'latitude': latitude,
+            'longitude': longitude,
+            'address': location_name,
+            'user_id': current_user.id
+        }
+        if group_commit.GROUP_COMMIT_ENABLED:
+            # Shares one commit with other concurrent location updates; returns once it's durable
+            group_commit.get_writer(sharding.engine_for(db, current_user.id)).write(Location.__table__, location_row)
+        else:
+            db.session.add(Location(**location_row))
+            db.session.commit()
 
         # Share with emergency contacts
         contacts = Contact.query.filter_by(user_id=current_user.id).all()
@@ -312,8 +442,216 @@ def share_location():
         print(f"Error sharing location: {str(e)}")
         return jsonify({'error': 'Failed to share location'}), 500
 
+def reverse_geocode(latitude, longitude, priority='sos'):
+    """
+    Return the address for a position through the shared geocoding queue (see geocoding.py).
+    Falls back to coordinate text if Nominatim can't be asked in time.
+    """
+    try:
+        return geocoding.get_service().reverse(latitude, longitude, priority)
+    except Exception as e:
+        print(f"Error getting location name: {str(e)}")
+        return "Unknown Location"
+
+def is_in_safety_zone(user_id, latitude, longitude):
+    """Check whether a position falls inside any of the user's safety zones"""
+    safety_zones = SafetyZone.query.filter_by(user_id=user_id).all()
+    for zone in safety_zones:
+        try:
+            distance = geodesic(
+                (latitude, longitude),
+                (zone.latitude, zone.longitude)
+            ).meters
+            if distance <= zone.radius:
+                return True
+        except Exception as e:
+            print(f"Error calculating distance to safety zone: {str(e)}")
+            continue
+    return False
+
+# Zone status polling: how often a stationary client is asked to re-check, and
+# the speed used to turn the distance to the nearest zone edge into a delay
+ZONE_RECHECK_MIN_SECONDS = float(os.getenv('ZONE_RECHECK_MIN_SECONDS', 10))
+ZONE_RECHECK_MAX_SECONDS = float(os.getenv('ZONE_RECHECK_MAX_SECONDS', 300))
+ZONE_ASSUMED_SPEED = float(os.getenv('ZONE_ASSUMED_SPEED', 1.5))  # meters per second, walking
+
+def zone_status(user_id, latitude, longitude, nearby_limit=5):
+    """
+    Work out where a position stands relative to the user's safety zones
+
+    Parameters:
+    user_id (int): Owner of the zones
+    latitude (float): Current latitude
+    longitude (float): Current longitude
+    nearby_limit (int): Number of closest zones to list
+
+    Returns:
+    dict: Containment, the nearest zone edge, how far the user can move before
+        the answer could change ('safe_distance'), and when to re-check
+    """
+    zones = []
+    for zone in cached_zones(user_id):
+        distance = geodesic((latitude, longitude), (zone['latitude'], zone['longitude'])).meters
+        zones.append({
+            'id': zone['id'],
+            'name': zone['name'],
+            'description': zone['description'],
+            'distance': round(distance, 1),
+            'edge_distance': round(abs(distance - zone['radius']), 1),
+            'inside': distance <= zone['radius']
+        })
+    zones.sort(key=lambda zone: zone['distance'])
+
+    containing = [zone for zone in zones if zone['inside']]
+    nearest_edge = min(zones, key=lambda zone: zone['edge_distance']) if zones else None
+    # Nothing can change until the user crosses the closest boundary
+    safe_distance = nearest_edge['edge_distance'] if nearest_edge else None
+    if safe_distance is None:
+        recheck_after = ZONE_RECHECK_MAX_SECONDS
+    else:
+        recheck_after = min(max(safe_distance / ZONE_ASSUMED_SPEED, ZONE_RECHECK_MIN_SECONDS), ZONE_RECHECK_MAX_SECONDS)
+
+    return {
+        'in_zone': bool(containing),
+        'zone': containing[0]['name'] if containing else None,
+        'nearest_edge': nearest_edge,
+        'safe_distance': safe_distance,
+        'recheck_after': round(recheck_after),
+        'nearby': zones[:nearby_limit]
+    }
+
+def sos_maps_links(latitude, longitude):
+    """Google Maps links for the SOS position: (directions link, view link)"""
+    return (
+        f"https://www.google.com/maps/dir/?api=1&destination={latitude},{longitude}",
+        f"https://www.google.com/maps?q={latitude},{longitude}"
+    )
+
+def send_pushbullet_sos(username, user_id, latitude, longitude, location_name, in_safety_zone):
+    """Send the SOS to all emergency contacts through Pushbullet (see data.py)"""
+    maps_link, maps_view_link = sos_maps_links(latitude, longitude)
+    location_info = (
+        f"{location_name}\n"
+        f"Coordinates: {latitude}, {longitude}\n"
+        f"Safety Zone Status: {'Inside' if in_safety_zone else 'Outside'}\n\n"
+        f"📍 View location: {maps_view_link}\n"
+        f"🚗 Get directions: {maps_link}"
+    )
+    return send_emergency_alerts(
+        username,
+        location=location_info,
+        message_prefix="🚨 EMERGENCY ALERT 🚨",
+        user_id=user_id  # Pass the user ID instead of password
+    )
+
+def twilio_configured():
+    return bool(twilio_account_sid and twilio_auth_token and os.getenv('TWILIO_PHONE_NUMBER'))
+
+def send_twilio_sos(username, phones, latitude, longitude, location_name, in_safety_zone):
+    """
+    Send the SOS to the given phone numbers through Twilio
+
+    Returns:
+    dict: success (at least one SMS was sent), a summary message and the result per phone number
+    """
+    if not twilio_configured():
+        return {'success': False, 'message': 'Twilio is not configured'}
+
+    maps_link, maps_view_link = sos_maps_links(latitude, longitude)
+    results = []
+    for phone_number in phones:
+        try:
+            # Format phone number to E.164 format if needed
+            if not phone_number.startswith('+'):
+                phone_number = '+' + phone_number
+
+            message = twilio_client.messages.create(
+                body=(
+                    f"🚨 EMERGENCY ALERT 🚨\n\n"
+                    f"{username} has triggered an SOS signal!\n\n"
+                    f"Location: {location_name}\n"
+                    f"Coordinates: {latitude}, {longitude}\n"
+                    f"Safety Zone Status: {'Inside' if in_safety_zone else 'Outside'}\n\n"
+                    f"📍 View location: {maps_view_link}\n"
+                    f"🚗 Get directions: {maps_link}\n\n"
+                    f"Please respond immediately!\n"
+                    f"Call emergency services if needed."
+                ),
+                from_=os.getenv('TWILIO_PHONE_NUMBER'),
+                to=phone_number
+            )
+            print(f"Twilio SMS sent successfully to {phone_number}: {message.sid}")
+            results.append({'phone': phone_number, 'success': True})
+        except Exception as e:
+            print(f"Error sending Twilio SMS to {phone_number}: {str(e)}")
+            results.append({'phone': phone_number, 'success': False, 'error': str(e)})
+            continue
+
+    successful = sum(1 for result in results if result['success'])
+    return {
+        'success': successful > 0,
+        'message': f"Sent SMS to {successful} of {len(results)} contacts",
+        'results': results
+    }
+
+def deliver_sos(username, user_id, phones, latitude, longitude, location_name, in_safety_zone):
+    """
+    Send the SOS through the healthiest provider, hedging to the other one
+    if it is slow or reached only some contacts, and skipping providers whose
+    circuit is open (see provider_health.py)
+    """
+    providers = {
+        'pushbullet': lambda: send_pushbullet_sos(
+            username, user_id, latitude, longitude, location_name, in_safety_zone
+        )
+    }
+    if twilio_configured():
+        providers['twilio'] = lambda: send_twilio_sos(
+            username, phones, latitude, longitude, location_name, in_safety_zone
+        )
+    return send_with_failover(providers)
+
+def provider_status(delivery, name):
+    """Human readable delivery status of one provider"""
+    if name in delivery['results']:
+        result = delivery['results'][name]
+        if isinstance(result, dict):
+            return result.get('message', 'Failed')
+        return 'Sent' if result else 'Failed'
+    if name in delivery['skipped']:
+        return 'Skipped (provider unhealthy)'
+    if name in delivery['attempted']:
+        return 'Still sending'
+    return 'Not used'
+
+def sos_response(emergency_id, latitude, longitude, location_name, in_safety_zone, delivery, **extra):
+    """Build the JSON response shared by the SOS routes"""
+    if not delivery['success']:
+        print("Warning: No emergency messages were sent successfully")
+        return jsonify({
+            'message': 'Emergency recorded but alert sending failed',
+            'emergency_id': emergency_id,
+            'location': location_name,
+            'in_safety_zone': in_safety_zone,
+            **extra
+        }), 500
+
+    return jsonify({
+        'message': 'SOS alert sent successfully',
+        'emergency_id': emergency_id,
+        'location': location_name,
+        'in_safety_zone': in_safety_zone,
+        'maps_link': sos_maps_links(latitude, longitude)[0],
+        'delivered_via': delivery['provider'],
+        'all_contacts_reached': delivery['complete'],
+        'pushbullet_status': provider_status(delivery, 'pushbullet'),
+        'twilio_status': provider_status(delivery, 'twilio'),
+        **extra
+    })
+
 @app.route('/sos', methods=['POST'])
 @login_required
+@rate_limited('sos', per_user=(5, 60), per_route=(50, 1), first_sos_exempt=True)
 def sos():
     try:
         # Get user's location
@@ -325,34 +663,8 @@ def sos():
             print("Error: Location data not provided")
             return jsonify({'error': 'Location data not provided'}), 400
 
-        # Get location name using geopy
-        try:
-            geolocator = Nominatim(user_agent="women_safety_app")
-            location = geolocator.reverse(f"{latitude}, {longitude}")
-            location_name = location.address if location else "Unknown Location"
-        except Exception as e:
-            print(f"Error getting location name: {str(e)}")
-            location_name = "Unknown Location"
-
-        # Create Google Maps links for navigation
-        maps_link = f"https://www.google.com/maps/dir/?api=1&destination={latitude},{longitude}"
-        maps_view_link = f"https://www.google.com/maps?q={latitude},{longitude}"
-
-        # Check if user is in any safety zone
-        safety_zones = SafetyZone.query.filter_by(user_id=current_user.id).all()
-        in_safety_zone = False
-        for zone in safety_zones:
-            try:
-                distance = geodesic(
-                    (latitude, longitude),
-                    (zone.latitude, zone.longitude)
-                ).meters
-                if distance <= zone.radius:
-                    in_safety_zone = True
-                    break
-            except Exception as e:
-                print(f"Error calculating distance to safety zone: {str(e)}")
-                continue
+        location_name = reverse_geocode(latitude, longitude)
+        in_safety_zone = is_in_safety_zone(current_user.id, latitude, longitude)
 
         # Create emergency history record
         emergency = EmergencyHistory(
@@ -364,88 +676,268 @@ def sos():
             description='Emergency SOS triggered'
         )
         db.session.add(emergency)
+        analytics.record_emergency(db.session, current_user.id, float(latitude), float(longitude))
         db.session.commit()
+        page_cache.bump('emergencies', current_user.id)
 
-        # Use the send_emergency_alerts function from data.py
-        # This will send messages to all emergency contacts using Pushbullet
-        message_prefix = "🚨 EMERGENCY ALERT 🚨"
-        location_info = (
-            f"{location_name}\n"
-            f"Coordinates: {latitude}, {longitude}\n"
-            f"Safety Zone Status: {'Inside' if in_safety_zone else 'Outside'}\n\n"
-            f"📍 View location: {maps_view_link}\n"
-            f"🚗 Get directions: {maps_link}"
-        )
-        
-        alert_result = send_emergency_alerts(
-            current_user.username,  # Use current user's username
-            location=location_info,
-            message_prefix=message_prefix,
-            user_id=current_user.id  # Pass the user ID instead of password
+        # Alert all emergency contacts through Pushbullet or Twilio
+        contacts = Contact.query.filter_by(user_id=current_user.id).all()
+        delivery = deliver_sos(
+            current_user.username, current_user.id, [contact.phone for contact in contacts],
+            latitude, longitude, location_name, in_safety_zone
         )
-        
-        # Check if Pushbullet alerts were successful
-        pushbullet_success = alert_result.get('success', False)
-        
-        # Try Twilio as backup if Pushbullet failed or if Twilio is configured
-        twilio_success = False
-        if twilio_account_sid and twilio_auth_token and os.getenv('TWILIO_PHONE_NUMBER'):
-            contacts = Contact.query.filter_by(user_id=current_user.id).all()
-            
-            for contact in contacts:
-                try:
-                    # Format phone number to E.164 format if needed
-                    phone_number = contact.phone
-                    if not phone_number.startswith('+'):
-                        phone_number = '+' + phone_number
-
-                    message = twilio_client.messages.create(
-                        body=(
-                            f"🚨 EMERGENCY ALERT 🚨\n\n"
-                            f"{current_user.username} has triggered an SOS signal!\n\n"
-                            f"Location: {location_name}\n"
-                            f"Coordinates: {latitude}, {longitude}\n"
-                            f"Safety Zone Status: {'Inside' if in_safety_zone else 'Outside'}\n\n"
-                            f"📍 View location: {maps_view_link}\n"
-                            f"🚗 Get directions: {maps_link}\n\n"
-                            f"Please respond immediately!\n"
-                            f"Call emergency services if needed."
-                        ),
-                        from_=os.getenv('TWILIO_PHONE_NUMBER'),
-                        to=phone_number
-                    )
-                    print(f"Twilio SMS sent successfully to {phone_number}: {message.sid}")
-                    twilio_success = True
-                except Exception as e:
-                    print(f"Error sending Twilio SMS to {contact.phone}: {str(e)}")
-                    continue
-
-        # Determine overall success
-        alerts_sent = pushbullet_success or twilio_success
-        
-        if not alerts_sent:
-            print("Warning: No emergency messages were sent successfully")
-            return jsonify({
-                'message': 'Emergency recorded but alert sending failed',
-                'emergency_id': emergency.id,
-                'location': location_name,
-                'in_safety_zone': in_safety_zone
-            }), 500
 
-        return jsonify({
-            'message': 'SOS alert sent successfully',
-            'emergency_id': emergency.id,
-            'location': location_name,
-            'in_safety_zone': in_safety_zone,
-            'maps_link': maps_link,
-            'pushbullet_status': alert_result.get('message', 'Failed'),
-            'twilio_status': 'Sent' if twilio_success else 'Failed or not configured'
-        })
+        return sos_response(
+            emergency.id, latitude, longitude, location_name, in_safety_zone, delivery
+        )
 
     except Exception as e:
         print(f"Error in SOS route: {str(e)}")
         return jsonify({'error': 'Failed to send SOS alert'}), 500
 
+@app.route('/sos/async', methods=['POST'])
+@rate_limited('sos', per_user=(5, 60), per_route=(50, 1), first_sos_exempt=True)
+async def sos_async():
+    """
+    SOS pipeline that runs independent stages concurrently.
+
+    Geocoding, the safety zone check and the EmergencyHistory insert don't
+    depend on each other, so they run at the same time. The emergency is
+    written with a provisional location name which is patched once geocoding
+    finishes. Alerts then go out through deliver_sos().
+    Per-stage wall-clock timings (ms) are returned under 'timings'.
+    """
+    # login_required can't wrap a coroutine view on this Flask-Login version
+    if not current_user.is_authenticated:
+        return login_manager.unauthorized()
+
+    try:
+        started = time.perf_counter()
+        data = request.get_json()
+        latitude = data.get('latitude')
+        longitude = data.get('longitude')
+
+        if not latitude or not longitude:
+            print("Error: Location data not provided")
+            return jsonify({'error': 'Location data not provided'}), 400
+
+        user_id = current_user.id
+        username = current_user.username
+        timings = {}
+
+        async def stage(name, fn, *args):
+            # Each stage runs in a worker thread with its own app context
+            def run():
+                with app.app_context(), sharding.user_context(user_id):
+                    return fn(*args)
+            stage_started = time.perf_counter()
+            result = await asyncio.to_thread(run)
+            timings[name] = round((time.perf_counter() - stage_started) * 1000, 1)
+            return result
+
+        def write_emergency():
+            emergency = EmergencyHistory(
+                user_id=user_id,
+                latitude=latitude,
+                longitude=longitude,
+                location_name=f"Coordinates: {latitude}, {longitude}",
+                status='active',
+                description='Emergency SOS triggered'
+            )
+            db.session.add(emergency)
+            analytics.record_emergency(db.session, user_id, float(latitude), float(longitude))
+            db.session.commit()
+            page_cache.bump('emergencies', user_id)
+            return emergency.id
+
+        def patch_location_name(emergency_id, location_name):
+            emergency = EmergencyHistory.query.get(emergency_id)
+            emergency.location_name = location_name
+            db.session.commit()
+            page_cache.bump('emergencies', user_id)
+
+        def contact_phones():
+            return [contact.phone for contact in Contact.query.filter_by(user_id=user_id).all()]
+
+        location_name, in_safety_zone, emergency_id, phones = await asyncio.gather(
+            stage('geocode', reverse_geocode, latitude, longitude),
+            stage('zone_check', is_in_safety_zone, user_id, latitude, longitude),
+            stage('db_write', write_emergency),
+            stage('contacts', contact_phones)
+        )
+
+        _, delivery = await asyncio.gather(
+            stage('patch_location', patch_location_name, emergency_id, location_name),
+            stage('alerts', deliver_sos,
+                  username, user_id, phones, latitude, longitude, location_name, in_safety_zone)
+        )
+
+        timings['total'] = round((time.perf_counter() - started) * 1000, 1)
+        print(f"SOS stage timings (ms): {timings}")
+
+        return sos_response(
+            emergency_id, latitude, longitude, location_name, in_safety_zone,
+            delivery, timings=timings
+        )
+
+    except Exception as e:
+        print(f"Error in async SOS route: {str(e)}")
+        return jsonify({'error': 'Failed to send SOS alert'}), 500
+
+# Offline queue sync: the most events accepted in one request, and how far
+# into the future a client clock may be before its timestamps are ignored
+SYNC_MAX_EVENTS = int(os.getenv('SYNC_MAX_EVENTS', 500))
+SYNC_MAX_CLOCK_SKEW = float(os.getenv('SYNC_MAX_CLOCK_SKEW', 300))
+
+def sync_event_time(client_ms):
+    """Convert a client timestamp (epoch milliseconds) to UTC, falling back to now if it is unusable"""
+    now = datetime.utcnow()
+    try:
+        timestamp = datetime.utcfromtimestamp(float(client_ms) / 1000)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return now
+    return now if (timestamp - now).total_seconds() > SYNC_MAX_CLOCK_SKEW else timestamp
+
+def sync_batch_has_sos():
+    """Whether the /api/sync batch in this request holds an SOS (only those get the first-SOS rate limit pass)"""
+    events = (request.get_json(silent=True) or {}).get('events')
+    return isinstance(events, list) and any(isinstance(item, list) and len(item) > 1 and item[1] == 's' for item in events)
+
+@app.route('/api/sync', methods=['POST'])
+@login_required
+@rate_limited('sync', per_user=(10, 60), per_route=(50, 1), first_sos_exempt=sync_batch_has_sos)
+def sync_events():
+    """
+    Apply a batch of events a client queued while offline.
+
+    Body: {"device": "<id>", "events": [[seq, type, client_ms, lat, lng], ...]}
+    where type is "s" (SOS) or "l" (location) and seq increases per device.
+    Events at or below the device's cursor were applied before and are
+    skipped, so a batch can be re-sent safely. The whole batch is written in
+    one transaction. Alerts go out once, for the newest SOS in the batch.
+    Malformed events are counted in "rejected"; those with a readable seq
+    are acknowledged with the batch so the client stops re-sending them.
+
+    Returns {"ack": seq}: the client can drop every event up to seq. A batch
+    with an SOS also gets emergency_id and alerts_sent; if no contact could
+    be alerted the status is 500 with an error, though the events are
+    still acknowledged.
+    """
+    data = request.get_json(silent=True) or {}
+    device = str(data.get('device') or '')[:64]
+    events = data.get('events')
+    if not device or not isinstance(events, list):
+        return jsonify({'error': 'device and events are required'}), 400
+    if len(events) > SYNC_MAX_EVENTS:
+        return jsonify({'error': f'At most {SYNC_MAX_EVENTS} events per request'}), 413
+
+    user_id = current_user.id
+    cursor = SyncCursor.query.filter_by(user_id=user_id, device=device).first()
+    acked = cursor.seq if cursor else 0
+
+    rejected = 0
+    pending = []
+    for item in events:
+        seq = item[0] if isinstance(item, list) and item else None
+        if not isinstance(seq, int) or isinstance(seq, bool):
+            # Without a seq there is nothing to acknowledge it by
+            rejected += 1
+        elif seq > acked:
+            pending.append(item)
+    pending.sort(key=lambda item: item[0])
+    if not pending:
+        response = {'ack': acked}
+        if rejected:
+            response['rejected'] = rejected
+        return jsonify(response)
+
+    locations, emergencies, newest_sos = [], [], None
+    for item in pending:
+        try:
+            if len(item) != 5:
+                raise ValueError(item)
+            seq, kind, client_ms, latitude, longitude = item
+            latitude, longitude = float(latitude), float(longitude)
+            if kind not in ('s', 'l') or not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                raise ValueError(kind)
+        except (TypeError, ValueError):
+            rejected += 1
+            continue
+        timestamp = sync_event_time(client_ms)
+        if kind == 'l':
+            locations.append({
+                'latitude': latitude,
+                'longitude': longitude,
+                'address': f"Coordinates: {latitude}, {longitude}",
+                'timestamp': timestamp,
+                'user_id': user_id
+            })
+        else:
+            emergency = EmergencyHistory(
+                user_id=user_id,
+                timestamp=timestamp,
+                latitude=latitude,
+                longitude=longitude,
+                location_name=f"Coordinates: {latitude}, {longitude}",
+                status='active',
+                description='Emergency SOS triggered (sent after reconnecting)'
+            )
+            emergencies.append(emergency)
+            newest_sos = emergency
+
+    last_seq = pending[-1][0]
+    try:
+        if newest_sos is not None:
+            newest_sos.location_name = reverse_geocode(newest_sos.latitude, newest_sos.longitude)
+        for emergency in emergencies:
+            db.session.add(emergency)
+            analytics.record_emergency(db.session, user_id, emergency.latitude, emergency.longitude, emergency.timestamp)
+        if locations:
+            db.session.execute(Location.__table__.insert(), locations)
+
+        if cursor is None:
+            db.session.add(SyncCursor(user_id=user_id, device=device, seq=last_seq))
+        else:
+            # Only advance from the cursor we read, so an overlapping retry can't apply the batch twice
+            updated = SyncCursor.query.filter_by(id=cursor.id, seq=acked) \
+                .update({'seq': last_seq, 'updated_at': datetime.utcnow()}, synchronize_session=False)
+            if not updated:
+                raise IntegrityError('sync cursor moved', None, None)
+        db.session.commit()
+    except IntegrityError:
+        # Another request from this device got there first; report where it left the cursor
+        db.session.rollback()
+        cursor = SyncCursor.query.filter_by(user_id=user_id, device=device).first()
+        return jsonify({'ack': cursor.seq if cursor else 0}), 409
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error applying synced events: {str(e)}")
+        return jsonify({'error': 'Failed to apply events', 'ack': acked}), 500
+
+    response = {'ack': last_seq}
+    if rejected:
+        response['rejected'] = rejected
+    if emergencies:
+        page_cache.bump('emergencies', user_id)
+        contacts = Contact.query.filter_by(user_id=user_id).all()
+        delivery = deliver_sos(
+            current_user.username, user_id, [contact.phone for contact in contacts],
+            newest_sos.latitude, newest_sos.longitude, newest_sos.location_name,
+            is_in_safety_zone(user_id, newest_sos.latitude, newest_sos.longitude)
+        )
+        response['emergency_id'] = newest_sos.id
+        response['alerts_sent'] = delivery['success']
+        if not delivery['success']:
+            print("Warning: No emergency messages were sent successfully for a synced SOS")
+            response['error'] = 'Emergency recorded but alert sending failed'
+            return jsonify(response), 500
+    return jsonify(response)
+
+@app.route('/api/provider-health', methods=['GET'])
+@login_required
+def provider_health():
+    return jsonify(health_report())
+
 @app.route('/contacts', methods=['GET', 'POST'])
 @login_required
 def manage_contacts():
@@ -462,6 +954,7 @@ def manage_contacts():
         )
         db.session.add(contact)
         db.session.commit()
+        page_cache.bump('contacts', current_user.id)
         
         flash('Contact added successfully!')
         return redirect(url_for('manage_contacts'))
@@ -472,59 +965,67 @@ def manage_contacts():
 @app.route('/emergency-history')
 @login_required
 def emergency_history():
-    history = EmergencyHistory.query.filter_by(user_id=current_user.id).order_by(EmergencyHistory.timestamp.desc()).all()
-    return render_template('emergency_history.html', history=history)
+    user_id = current_user.id
+    history_html = page_cache.cached('fragment:emergency-history', user_id, ['emergencies'], lambda: render_template(
+        'partials/emergency_history_rows.html',
+        history=EmergencyHistory.query.filter_by(user_id=user_id).order_by(EmergencyHistory.timestamp.desc()).all()
+    ))
+    return render_template(
+        'emergency_history.html',
+        has_history=emergency_summary(user_id)['count'] > 0,
+        history_html=history_html
+    )
+
+# Built once at startup; the list never changes between requests
+EMERGENCY_SERVICES = [
+    {
+        'name': 'Police',
+        'number': '100',
+        'description': 'For crime, violence, or immediate threats',
+        'icon': 'fas fa-shield-alt',
+        'color': '#007bff'
+    },
+    {
+        'name': 'Women Helpline',
+        'number': '1091',
+        'description': 'National helpline for women in distress',
+        'icon': 'fas fa-venus',
+        'color': '#e83e8c'
+    },
+    {
+        'name': 'Ambulance',
+        'number': '108',
+        'description': 'Medical emergencies and ambulance services',
+        'icon': 'fas fa-ambulance',
+        'color': '#dc3545'
+    },
+    {
+        'name': 'Fire Emergency',
+        'number': '101',
+        'description': 'For fire incidents and rescue operations',
+        'icon': 'fas fa-fire',
+        'color': '#fd7e14'
+    },
+    {
+        'name': 'Disaster Management',
+        'number': '1070',
+        'description': 'For natural disasters and emergency situations',
+        'icon': 'fas fa-radiation',
+        'color': '#6f42c1'
+    },
+    {
+        'name': 'Tourist Helpline',
+        'number': '1363',
+        'description': 'For tourists facing emergency situations',
+        'icon': 'fas fa-map-marked-alt',
+        'color': '#20c997'
+    }
+]
 
 @app.route('/emergency-services')
 @login_required
 def emergency_services():
-    # Define emergency services with their details
-    emergency_services = [
-        {
-            'name': 'Police',
-            'number': '100',
-            'description': 'For crime, violence, or immediate threats',
-            'icon': 'fas fa-shield-alt',
-            'color': '#007bff'
-        },
-        {
-            'name': 'Women Helpline',
-            'number': '1091',
-            'description': 'National helpline for women in distress',
-            'icon': 'fas fa-venus',
-            'color': '#e83e8c'
-        },
-        {
-            'name': 'Ambulance',
-            'number': '108',
-            'description': 'Medical emergencies and ambulance services',
-            'icon': 'fas fa-ambulance',
-            'color': '#dc3545'
-        },
-        {
-            'name': 'Fire Emergency',
-            'number': '101',
-            'description': 'For fire incidents and rescue operations',
-            'icon': 'fas fa-fire',
-            'color': '#fd7e14'
-        },
-        {
-            'name': 'Disaster Management',
-            'number': '1070',
-            'description': 'For natural disasters and emergency situations',
-            'icon': 'fas fa-radiation',
-            'color': '#6f42c1'
-        },
-        {
-            'name': 'Tourist Helpline',
-            'number': '1363',
-            'description': 'For tourists facing emergency situations',
-            'icon': 'fas fa-map-marked-alt',
-            'color': '#20c997'
-        }
-    ]
-    
-    return render_template('emergency_services.html', services=emergency_services)
+    return render_template('emergency_services.html', services=EMERGENCY_SERVICES)
 
 @app.route('/logout')
 @login_required
@@ -545,8 +1046,11 @@ def update_emergency_status(emergency_id):
         
         status = request.form.get('status')
         if status in ['active', 'resolved']:
+            if status == 'resolved' and emergency.status != 'resolved':
+                analytics.record_resolution(db.session, emergency.user_id, emergency.timestamp)
             emergency.status = status
             db.session.commit()
+            page_cache.bump('emergencies', current_user.id)
             flash(f'Emergency status updated to {status}', 'success')
         else:
             flash('Invalid status value', 'danger')
@@ -556,17 +1060,47 @@ def update_emergency_status(emergency_id):
         flash(f'Error updating emergency status: {str(e)}', 'danger')
         return redirect(url_for('emergency_history'))
 
+@app.route('/api/analytics/trends', methods=['GET'])
+@login_required
+def analytics_trends():
+    days = min(request.args.get('days', 30, type=int), 365)
+    return jsonify(analytics.user_trend(db.session, current_user.id, days))
+
+# Heatmap cells with fewer emergencies than this are left out, so a sparse
+# cell can't be traced back to one person's SOS
+HEATMAP_MIN_COUNT = int(os.getenv('HEATMAP_MIN_COUNT', 5))
+
+@app.route('/api/analytics/heatmap', methods=['GET'])
+@login_required
+@admin_required
+def analytics_heatmap():
+    tile = request.args.get('tile', '')
+    if not analytics.is_geohash(tile):
+        return jsonify({'error': 'tile must be a geohash prefix'}), 400
+    hours = min(request.args.get('hours', 24, type=int), 24 * 90)
+    # Regional rollups are spread over the shards, so merge the counts from each
+    cells = {}
+    for engine in sharding.engines(db):
+        with engine.connect() as conn:
+            for cell in analytics.heatmap_tile(conn, tile, hours):
+                if cell['cell'] in cells:
+                    cells[cell['cell']]['count'] += cell['count']
+                else:
+                    cells[cell['cell']] = cell
+    shown = [cell for cell in cells.values() if cell['count'] >= HEATMAP_MIN_COUNT]
+    return jsonify({
+        'tile': tile,
+        'hours': hours,
+        'min_count': HEATMAP_MIN_COUNT,
+        'cells': shown,
+        'suppressed': len(cells) - len(shown)
+    })
+
 @app.route('/api/contacts', methods=['GET'])
 @login_required
 def get_contacts():
     try:
-        contacts = Contact.query.filter_by(user_id=current_user.id).all()
-        return jsonify([{
-            'id': contact.id,
-            'name': contact.name,
-            'phone': contact.phone,
-            'relationship': contact.relationship
-        } for contact in contacts])
+        return jsonify(cached_contacts(current_user.id))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -583,6 +1117,7 @@ def create_contact():
         )
         db.session.add(contact)
         db.session.commit()
+        page_cache.bump('contacts', current_user.id)
         return jsonify({
             'message': 'Contact created successfully',
             'contact': {
@@ -610,6 +1145,7 @@ def update_contact(contact_id):
         contact.relationship = data.get('relationship', contact.relationship)
         
         db.session.commit()
+        page_cache.bump('contacts', current_user.id)
         return jsonify({
             'message': 'Contact updated successfully',
             'contact': {
@@ -633,6 +1169,7 @@ def delete_contact(contact_id):
         
         db.session.delete(contact)
         db.session.commit()
+        page_cache.bump('contacts', current_user.id)
         return jsonify({'message': 'Contact deleted successfully'})
     except Exception as e:
         db.session.rollback()
@@ -640,5 +1177,5 @@ def delete_contact(contact_id):
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        sharding.create_all(db)
     app.run(host='127.0.0.1', port=8080, debug=True) 
\ No newline at end of file
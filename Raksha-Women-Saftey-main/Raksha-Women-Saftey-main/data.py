@@ -1,10 +1,10 @@
-from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import check_password_hash
 from flask import Flask
 import os
 from dotenv import load_dotenv
 import subprocess
 import json
+import sharding
 
 # Load environment variables
 load_dotenv()
@@ -12,8 +12,9 @@ load_dotenv()
 # Initialize a minimal Flask app to use with SQLAlchemy
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///women_safety.db'
+app.config['SQLALCHEMY_BINDS'] = sharding.shard_binds()
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+db = sharding.ShardedSQLAlchemy(app)
 
 # Define the User and Contact models (simplified versions of those in app.py)
 class User(db.Model):
@@ -73,8 +74,9 @@ def get_emergency_contacts(username, password=None, user_id=None):
                         "message": "Invalid password"
                     }
             
-            # Retrieve user's emergency contacts
-            contacts = Contact.query.filter_by(user_id=user.id).all()
+            # Retrieve user's emergency contacts from the user's shard
+            with sharding.user_context(user.id):
+                contacts = Contact.query.filter_by(user_id=user.id).all()
             
             # Format contacts into a dictionary
             contacts_list = []
@@ -139,7 +141,7 @@ def send_emergency_alerts(username, password=None, location="", message_prefix="
         
         # Pushbullet API key and device ID
         api_key = os.getenv('PUSHBULLET_API_KEY', 'o.b4mbchHpAfij0odL3ornqGvcxYnXwDIq')  # Default to your key
-        device_id = os.getenv('PUSHBULLET_DEVICE_ID', 'ujAQHzKKZCSsjCBEeHexUq')  # Default to your device
+        device_id = os.getenv('PUSHBULLET_DEVICE_ID', 'auto')  # "auto" picks active SMS devices (see push.DeviceRegistry)
         
         # Prepare emergency message
         emergency_message = f"{message_prefix}\n\nUser: {username}"
@@ -147,44 +149,51 @@ def send_emergency_alerts(username, password=None, location="", message_prefix="
             emergency_message += f"\nLocation: {location}"
         emergency_message += "\nPlease respond immediately!"
         
-        # Send messages to all contacts
-        results = []
-        for contact in contacts_result["contacts"]:
-            try:
-                # Command to send message using push.py
-                cmd = [
-                    "python", 
-                    "push.py", 
-                    "--api-key", api_key,
-                    "--device", device_id,
-                    "--number", contact["phone"],
-                    "--message", f"{emergency_message}\n\nContact: {contact['name']} ({contact['relationship']})"
-                ]
-                
-                # Execute the command
-                process = subprocess.run(cmd, capture_output=True, text=True)
-                
-                # Check if message was sent successfully
-                if process.returncode == 0 and "successfully" in process.stdout:
-                    results.append({
-                        "contact": contact["name"],
-                        "phone": contact["phone"],
-                        "success": True
-                    })
+        # Send messages to all contacts with a single push.py batch run
+        contacts = contacts_result["contacts"]
+        batch = [{
+            "number": contact["phone"],
+            "message": f"{emergency_message}\n\nContact: {contact['name']} ({contact['relationship']})"
+        } for contact in contacts]
+        
+        results = [{
+            "contact": contact["name"],
+            "phone": contact["phone"],
+            "success": False,
+            "error": "No result from push.py"
+        } for contact in contacts]
+        
+        try:
+            cmd = [
+                "python", 
+                "push.py", 
+                "--api-key", api_key,
+                "--device", device_id,
+                "--batch", "-"
+            ]
+            
+            # Execute the command, feeding the batch on stdin
+            process = subprocess.run(cmd, input=json.dumps(batch), capture_output=True, text=True)
+            
+            # push.py writes one NDJSON result line per message
+            for line in process.stdout.splitlines():
+                try:
+                    line_result = json.loads(line)
+                except ValueError:
+                    continue
+                result = results[line_result["index"]]
+                result["success"] = line_result["success"]
+                if line_result["success"]:
+                    result.pop("error", None)
                 else:
-                    results.append({
-                        "contact": contact["name"],
-                        "phone": contact["phone"],
-                        "success": False,
-                        "error": process.stderr or process.stdout
-                    })
-            except Exception as e:
-                results.append({
-                    "contact": contact["name"],
-                    "phone": contact["phone"],
-                    "success": False,
-                    "error": str(e)
-                })
+                    result["error"] = line_result.get("error", "Unknown error")
+            
+            if process.returncode != 0 and not process.stdout:
+                for result in results:
+                    result["error"] = process.stderr or "push.py failed"
+        except Exception as e:
+            for result in results:
+                result["error"] = str(e)
         
         # Calculate success rate
         successful = sum(1 for r in results if r["success"])
@@ -0,0 +1,255 @@
+"""
+Reverse geocoding through one rate-limited queue.
+
+Nominatim's usage policy allows one request per second, and concurrent SOS
+and share-location requests from the same area used to look up the same
+place several times over. Every lookup now goes through GeocodingService:
+
+- positions are rounded to a cell (GEOCODE_CELL_DECIMALS, ~11m by default)
+  and answers are cached per cell in the shared state backend
+- concurrent lookups for the same cell share one call (single flight)
+- calls are made by one worker thread per process, and a token bucket in the
+  shared state backend holds all workers together to GEOCODE_RATE per second
+- queued SOS lookups always go before location shares
+- a lookup that can't get a turn within its wait budget (GEOCODE_SOS_WAIT,
+  GEOCODE_SHARE_WAIT) returns coordinate text instead
+
+    python geocoding.py --requests 60     # run a burst against a local fake geocoder
+"""
+
+import argparse
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from geopy.geocoders import Nominatim
+import shared_state
+from rate_limit import take_token
+
+GEOCODE_RATE = float(os.getenv('GEOCODE_RATE', 1))
+GEOCODE_CELL_DECIMALS = int(os.getenv('GEOCODE_CELL_DECIMALS', 4))
+GEOCODE_CACHE_TTL = float(os.getenv('GEOCODE_CACHE_TTL', 86400))
+GEOCODE_SOS_WAIT = float(os.getenv('GEOCODE_SOS_WAIT', 3))
+GEOCODE_SHARE_WAIT = float(os.getenv('GEOCODE_SHARE_WAIT', 2))
+
+PRIORITIES = {'sos': 0, 'share': 1}
+WAIT_BUDGETS = {'sos': GEOCODE_SOS_WAIT, 'share': GEOCODE_SHARE_WAIT}
+
+
+def coordinates_text(latitude, longitude):
+    return f"Coordinates: {latitude}, {longitude}"
+
+
+class FakeGeocoder:
+    """Stand-in for Nominatim that answers locally after a delay and counts its calls"""
+
+    def __init__(self, latency=0.1):
+        self.latency = latency
+        self.calls = []
+
+    def reverse(self, query):
+        self.calls.append(time.monotonic())
+        time.sleep(self.latency)
+        return type('Location', (), {'address': f"Fake address near {query}"})()
+
+
+class GeocodingService:
+    """Cached, collapsed and rate-limited reverse geocoding"""
+
+    def __init__(self, geocoder=None, rate=GEOCODE_RATE, cell_decimals=GEOCODE_CELL_DECIMALS,
+                 cache_ttl=GEOCODE_CACHE_TTL, backend=None):
+        self.geocoder = geocoder or Nominatim(user_agent="women_safety_app", timeout=5)
+        self.rate = rate
+        self.cell_decimals = cell_decimals
+        self.cache_ttl = cache_ttl
+        self.backend = backend
+        self.stats = {'requests': 0, 'cache_hits': 0, 'collapsed': 0, 'calls': 0, 'fallbacks': 0, 'errors': 0}
+        self._inflight = {}
+        self._queue = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name='geocoder', daemon=True).start()
+
+    def _backend(self):
+        return self.backend or shared_state.get_backend()
+
+    def reverse(self, latitude, longitude, priority='share'):
+        """
+        Return the address for a position
+
+        Parameters:
+        latitude (float): Latitude
+        longitude (float): Longitude
+        priority (str): 'sos' or 'share'; SOS lookups are served first and may wait longer
+
+        Returns:
+        str: The address, "Unknown Location" if there is none, or coordinate
+            text if no lookup could be made in time
+        """
+        latitude, longitude = float(latitude), float(longitude)
+        cell = f"{round(latitude, self.cell_decimals)},{round(longitude, self.cell_decimals)}"
+        wait = WAIT_BUDGETS.get(priority, GEOCODE_SHARE_WAIT)
+
+        with self._cond:
+            self.stats['requests'] += 1
+        address = self._backend().get(f"geo:{cell}")
+        if address is not None:
+            with self._cond:
+                self.stats['cache_hits'] += 1
+            return address
+
+        with self._cond:
+            future = self._inflight.get(cell)
+            if future is None:
+                future = Future()
+                self._inflight[cell] = future
+                heapq.heappush(self._queue, (
+                    PRIORITIES.get(priority, 1), next(self._order),
+                    cell, future, time.monotonic() + wait
+                ))
+                self._cond.notify()
+            else:
+                self.stats['collapsed'] += 1
+                # A waiting share lookup is promoted if an SOS needs the same cell
+                self._promote(cell, PRIORITIES.get(priority, 1), time.monotonic() + wait)
+
+        try:
+            address = future.result(timeout=wait)
+        except TimeoutError:
+            address = None
+        if address is None:
+            with self._cond:
+                self.stats['fallbacks'] += 1
+            return coordinates_text(latitude, longitude)
+        return address
+
+    def _promote(self, cell, priority, deadline):
+        for index, (queued_priority, order, queued_cell, future, queued_deadline) in enumerate(self._queue):
+            if queued_cell == cell and (priority < queued_priority or deadline > queued_deadline):
+                self._queue[index] = (min(priority, queued_priority), order, cell, future, max(deadline, queued_deadline))
+                heapq.heapify(self._queue)
+                return
+
+    def _finish(self, cell, future, address):
+        with self._cond:
+            self._inflight.pop(cell, None)
+        if not future.done():
+            future.set_result(address)
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                while not self._queue:
+                    self._cond.wait()
+                job = heapq.heappop(self._queue)
+                if job[4] > time.monotonic():
+                    return job
+                # Nobody is waiting for this one any more, so don't spend a call on it
+                self._inflight.pop(job[2], None)
+                job[3].set_result(None)
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            try:
+                self._serve(job)
+            except Exception as e:
+                # A failed lookup (or a locked shared state database) mustn't stop the worker;
+                # the callers fall back to coordinates
+                print(f"Error getting location name: {str(e)}")
+                with self._cond:
+                    self.stats['errors'] += 1
+                self._finish(job[2], job[3], None)
+
+    def _serve(self, job):
+        _, _, cell, future, deadline = job
+
+        allowed, retry_after = take_token('rl:geocode', self.rate, 1, backend=self._backend())
+        if not allowed:
+            # Put it back so a newly queued SOS can go first, then wait for the next token
+            with self._cond:
+                heapq.heappush(self._queue, job)
+                self._cond.wait(timeout=min(retry_after, max(deadline - time.monotonic(), 0.01)))
+            return
+
+        with self._cond:
+            self.stats['calls'] += 1
+        location = self.geocoder.reverse(cell.replace(',', ', '))
+        address = location.address if location else "Unknown Location"
+        self._backend().set(f"geo:{cell}", address, ttl=self.cache_ttl)
+        self._finish(cell, future, address)
+
+
+_service = None
+_service_pid = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """This process's geocoding service (the worker thread doesn't survive a fork)"""
+    global _service, _service_pid
+    with _service_lock:
+        if _service is None or _service_pid != os.getpid():
+            _service = GeocodingService()
+            _service_pid = os.getpid()
+        return _service
+
+
+def set_service(service):
+    global _service, _service_pid
+    with _service_lock:
+        _service = service
+        _service_pid = os.getpid()
+
+
+def run_bench(requests=60, cells=6, sos_share=0.25, latency=0.1, spread=5.0):
+    """Send a burst of lookups from a few nearby places to a fake geocoder and report what reached it"""
+    geocoder = FakeGeocoder(latency)
+    service = GeocodingService(geocoder, backend=shared_state.MemoryBackend())
+    places = [(12.9716 + n * 0.001, 77.5946) for n in range(cells)]
+    results = {'sos': [], 'share': []}
+    lock = threading.Lock()
+
+    def lookup(priority, latitude, longitude):
+        started = time.monotonic()
+        address = service.reverse(latitude, longitude, priority)
+        with lock:
+            results[priority].append((time.monotonic() - started, address.startswith('Coordinates:')))
+
+    threads = []
+    for _ in range(requests):
+        latitude, longitude = random.choice(places)
+        # Jitter of a metre or two lands in the same cell
+        latitude += random.uniform(-0.00001, 0.00001)
+        priority = 'sos' if random.random() < sos_share else 'share'
+        threads.append(threading.Thread(target=lookup, args=(priority, latitude, longitude)))
+    for thread in threads:
+        thread.start()
+        time.sleep(random.uniform(0, spread / requests))
+    for thread in threads:
+        thread.join()
+
+    calls = geocoder.calls
+    busiest = max((sum(1 for other in calls if 0 <= other - call < 1) for call in calls), default=0)
+    print(f"{requests} lookups over {cells} places: {len(calls)} geocoder calls, "
+          f"busiest second {busiest} call(s)")
+    print(f"Stats: {service.stats}")
+    for priority, timings in results.items():
+        if timings:
+            timings.sort()
+            fallbacks = sum(1 for _, fell_back in timings if fell_back)
+            print(f"{priority}: {len(timings)} lookups, p50 {timings[len(timings) // 2][0] * 1000:.0f}ms, "
+                  f"max {timings[-1][0] * 1000:.0f}ms, {fallbacks} fell back to coordinates")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Exercise the geocoding queue against a local fake geocoder")
+    parser.add_argument("--requests", type=int, default=60, help="Lookups in the burst")
+    parser.add_argument("--cells", type=int, default=6, help="Distinct places they come from")
+    parser.add_argument("--latency", type=float, default=0.1, help="Fake geocoder latency in seconds")
+    parser.add_argument("--spread", type=float, default=5.0, help="Seconds the burst is spread over")
+    args = parser.parse_args()
+    run_bench(args.requests, args.cells, latency=args.latency, spread=args.spread)
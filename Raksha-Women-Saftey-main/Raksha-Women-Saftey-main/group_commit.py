@@ -0,0 +1,239 @@
+"""
+Group commit for low-priority inserts.
+
+Each commit on SQLite is an fsync, so many small single-row commits cap
+write throughput. A GroupCommitWriter runs one thread per engine that
+collects inserts for up to GROUP_COMMIT_DELAY_MS and writes them in a
+single transaction. Callers wait for that transaction to commit, so a row
+is still durable before the request returns; concurrent requests just
+share the fsync. A caller that times out withdraws its row if the writer
+hasn't taken it yet, and otherwise waits for the commit, so a failed
+request never leaves a row behind that a retry would duplicate.
+
+It is opt-in (GROUP_COMMIT_ENABLED=1) and only used for Location rows.
+SOS rows are always committed directly with their analytics rollups.
+
+    python group_commit.py --threads 16 --rows 200    # throughput benchmark
+"""
+
+import argparse
+import atexit
+import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+GROUP_COMMIT_ENABLED = os.getenv('GROUP_COMMIT_ENABLED', '0') == '1'
+GROUP_COMMIT_DELAY_MS = float(os.getenv('GROUP_COMMIT_DELAY_MS', 5))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv('GROUP_COMMIT_MAX_BATCH', 500))
+GROUP_COMMIT_TIMEOUT = float(os.getenv('GROUP_COMMIT_TIMEOUT', 10))
+
+
+class GroupCommitWriter:
+    """Background thread that commits queued inserts in batches"""
+
+    def __init__(self, engine, delay=GROUP_COMMIT_DELAY_MS / 1000, max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.engine = engine
+        self.delay = delay
+        self.max_batch = max_batch
+        self.batches = 0
+        self.rows = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._conn = None
+        self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+
+    def submit(self, table, row):
+        """
+        Queue a row for insertion
+
+        Parameters:
+        table (Table): SQLAlchemy Core table to insert into
+        row (dict): Column values
+
+        Returns:
+        Future: Resolves once the row's transaction has committed
+        """
+        if self._closed:
+            raise RuntimeError("Group commit writer is closed")
+        future = Future()
+        self._queue.put((table, row, future))
+        return future
+
+    def write(self, table, row, timeout=GROUP_COMMIT_TIMEOUT):
+        """
+        Insert a row and wait until it has been committed
+
+        Raises TimeoutError only if the row was withdrawn before the writer
+        picked it up, so it is never written and the caller can safely retry.
+        A row already in a transaction is waited for to the end.
+        """
+        future = self.submit(table, row)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            if future.cancel():
+                raise
+            return future.result()
+
+    def close(self):
+        """Stop accepting rows and wait for the queued ones to be written"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # Finish this batch, then stop
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                if self._conn is not None:
+                    self._conn.close()
+                return
+            # Rows whose caller gave up waiting are dropped; the rest can no longer be withdrawn
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # One bad row shouldn't fail everyone else's insert, so fall back to a transaction per row
+                print(f"Group commit of {len(batch)} rows failed, retrying individually: {str(e)}")
+                for item in batch:
+                    try:
+                        self._commit([item])
+                    except Exception as row_error:
+                        item[2].set_exception(row_error)
+                continue
+            self.batches += 1
+            self.rows += len(batch)
+
+    def _commit(self, batch):
+        by_table = {}
+        for table, row, future in batch:
+            by_table.setdefault(table, []).append(row)
+        # Keep one connection open: closing the last SQLite connection checkpoints the WAL every time
+        if self._conn is None or self._conn.closed:
+            self._conn = self.engine.connect()
+        try:
+            with self._conn.begin():
+                for table, rows in by_table.items():
+                    self._conn.execute(table.insert(), rows)
+        except Exception:
+            self._conn.close()
+            self._conn = None
+            raise
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(engine):
+    """
+    Return this process's writer for an engine, starting it if needed.
+    Threads don't survive a fork, so each worker process gets its own.
+    """
+    key = (os.getpid(), id(engine))
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None:
+            writer = GroupCommitWriter(engine)
+            _writers[key] = writer
+            atexit.register(writer.close)
+        return writer
+
+
+def run_bench(threads=16, rows=200, delay_ms=GROUP_COMMIT_DELAY_MS):
+    """Compare per-row commits with group commit under concurrent inserts"""
+    from sqlalchemy import MetaData, Table, Column, Integer, Float, String, create_engine
+
+    metadata = MetaData()
+    location = Table(
+        'location', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('latitude', Float, nullable=False),
+        Column('longitude', Float, nullable=False),
+        Column('address', String(200)),
+        Column('user_id', Integer, nullable=False)
+    )
+
+    def run(label, insert):
+        latencies = []
+        lock = threading.Lock()
+
+        def worker(n):
+            mine = []
+            for i in range(rows):
+                started = time.perf_counter()
+                insert({'latitude': 12.9, 'longitude': 77.5, 'address': f"Bench {n}-{i}", 'user_id': n})
+                mine.append((time.perf_counter() - started) * 1000)
+            with lock:
+                latencies.extend(mine)
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        print(f"{label}: {len(latencies) / elapsed:.0f} rows/s, p50 {latencies[len(latencies) // 2]:.2f}ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)]:.2f}ms, max {latencies[-1]:.2f}ms")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(work_dir, 'bench.db')}", connect_args={'timeout': 30})
+        with engine.begin() as conn:
+            conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+        metadata.create_all(engine)
+        print(f"{threads} threads x {rows} inserts")
+
+        def direct(row):
+            with engine.begin() as conn:
+                conn.execute(location.insert(), row)
+
+        run("Commit per row", direct)
+
+        writer = GroupCommitWriter(engine, delay=delay_ms / 1000)
+        run(f"Group commit ({delay_ms:g}ms window)", lambda row: writer.write(location, row))
+        writer.close()
+        print(f"Group commit wrote {writer.rows} rows in {writer.batches} transactions "
+              f"({writer.rows / max(writer.batches, 1):.1f} rows per commit)")
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark group commit against per-row commits")
+    parser.add_argument("--threads", type=int, default=16, help="Concurrent writer threads")
+    parser.add_argument("--rows", type=int, default=200, help="Inserts per thread")
+    parser.add_argument("--delay-ms", type=float, default=GROUP_COMMIT_DELAY_MS, help="Batching window")
+    args = parser.parse_args()
+    run_bench(args.threads, args.rows, args.delay_ms)
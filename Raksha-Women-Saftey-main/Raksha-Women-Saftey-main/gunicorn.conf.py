@@ -0,0 +1,29 @@
+# Gunicorn settings for `gunicorn -c gunicorn.conf.py wsgi:app`
+# Every value can be overridden from the environment.
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:8080')
+
+# Most request time is spent waiting on Nominatim, Pushbullet and Twilio,
+# so threaded workers give more concurrency than extra processes alone.
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+keepalive = 5
+
+# Recycle workers now and then so slow leaks cannot build up
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = 200
+
+# Create tables once in the master instead of racing in every worker
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Pooled connections opened in the master must not be shared with workers
+    from app import db
+    import sharding
+    for engine in sharding.engines(db):
+        engine.dispose()
@@ -1,10 +1,11 @@
 from app import app, db, User, Contact, SafetyZone
+import sharding
 from werkzeug.security import generate_password_hash
 
 def init_database():
     with app.app_context():
-        # Create all tables
-        db.create_all()
+        # Create all tables, in every shard
+        sharding.create_all(db)
         
         # Check if test user exists
         test_user = User.query.filter_by(username='testuser').first()
@@ -39,7 +40,9 @@ def init_database():
             )
             db.session.add(safety_zone)
             
-            db.session.commit()
+            # The contact and zone are written to the test user's shard
+            with sharding.user_context(test_user.id):
+                db.session.commit()
             print("Test user and data created successfully!")
         else:
             print("Test user already exists!")
@@ -0,0 +1,175 @@
+"""
+Load test for the gunicorn deployment.
+
+Starts `gunicorn -c gunicorn.conf.py wsgi:app` on a scratch copy of the app
+for each worker count, logs in a set of test users and drives /dashboard and
+/share-location from concurrent client threads, then reports throughput and
+latency per worker count. The live databases are never touched.
+
+Geocoding answers are seeded into the shared state cache so the run measures
+the app rather than Nominatim, and rate limiting is switched off.
+
+    python loadtest.py --workers 1 2 4 --threads 16 --duration 10
+
+Run the client on a different machine from the server (or pin them to
+different cores) when measuring scaling; on a single core the client
+threads and the workers compete for the same CPU.
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+import shared_state
+from geocoding import GEOCODE_CELL_DECIMALS
+
+LATITUDE, LONGITUDE = 12.9716, 77.5946
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+SKIP = shutil.ignore_patterns('*.db', '*.db-*', '*.db.gz', '__pycache__', 'instance', 'backups', '.env')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(work_dir, workers, port):
+    """Start gunicorn on a scratch copy of the app and wait until it answers"""
+    env = dict(
+        os.environ,
+        WEB_CONCURRENCY=str(workers),
+        BIND=f"127.0.0.1:{port}",
+        RATE_LIMIT_ENABLED='false',
+        SHARED_STATE_BACKEND='sqlite',
+        PYTHONPATH=os.pathsep.join(filter(None, [os.environ.get('PYTHONPATH'), work_dir]))
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+        cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {server.returncode}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start within 60 seconds")
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def login_sessions(base_url, users):
+    sessions = []
+    for n in range(users):
+        session = requests.Session()
+        credentials = {'username': f"load{n}", 'password': 'load-test'}
+        session.post(f"{base_url}/register", data={**credentials, 'email': f"load{n}@example.com", 'phone': '0'})
+        session.post(f"{base_url}/login", data=credentials)
+        sessions.append(session)
+    return sessions
+
+
+def drive(base_url, sessions, threads, duration):
+    """Alternate dashboard loads and location shares from `threads` clients for `duration` seconds"""
+    results = {'dashboard': [], 'share-location': []}
+    errors = {'dashboard': 0, 'share-location': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(n):
+        session = sessions[n % len(sessions)]
+        timings = {'dashboard': [], 'share-location': []}
+        failed = {'dashboard': 0, 'share-location': 0}
+        turn = n
+        while time.monotonic() < deadline:
+            route = 'dashboard' if turn % 2 == 0 else 'share-location'
+            turn += 1
+            started = time.perf_counter()
+            try:
+                if route == 'dashboard':
+                    response = session.get(f"{base_url}/dashboard", allow_redirects=False, timeout=30)
+                else:
+                    response = session.post(f"{base_url}/share-location", timeout=30,
+                                            json={'latitude': LATITUDE, 'longitude': LONGITUDE})
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                timings[route].append((time.perf_counter() - started) * 1000)
+            else:
+                failed[route] += 1
+        with lock:
+            for route in results:
+                results[route].extend(timings[route])
+                errors[route] += failed[route]
+
+    started = time.monotonic()
+    clients = [threading.Thread(target=client, args=(n,)) for n in range(threads)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return results, errors, time.monotonic() - started
+
+
+def run_bench(worker_counts=(1, 2, 4), threads=16, duration=10, users=16):
+    """Measure requests per second for each worker count"""
+    print(f"{threads} client threads, {users} users, {duration:g}s per run, {os.cpu_count()} CPU(s)")
+    baseline = None
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as scratch:
+            work_dir = os.path.join(scratch, 'app')
+            shutil.copytree(APP_DIR, work_dir, ignore=SKIP)
+            cell = f"{round(LATITUDE, GEOCODE_CELL_DECIMALS)},{round(LONGITUDE, GEOCODE_CELL_DECIMALS)}"
+            shared_state.create_backend('sqlite', os.path.join(work_dir, 'shared_state.db')) \
+                .set(f"geo:{cell}", "Load test address", ttl=86400)
+
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            server = start_server(work_dir, workers, port)
+            try:
+                sessions = login_sessions(base_url, users)
+                drive(base_url, sessions, threads, 1)  # Warm up caches and connections
+                results, errors, elapsed = drive(base_url, sessions, threads, duration)
+            finally:
+                stop_server(server)
+
+        total = sum(len(timings) for timings in results.values())
+        rate = total / elapsed
+        baseline = baseline or rate
+        print(f"{workers} worker(s): {rate:.0f} req/s ({rate / baseline:.2f}x)")
+        for route, timings in results.items():
+            timings.sort()
+            if timings:
+                print(f"  {route}: {len(timings)} ok, {errors[route]} failed, "
+                      f"p50 {timings[len(timings) // 2]:.1f}ms, p99 {timings[int(len(timings) * 0.99)]:.1f}ms")
+            else:
+                print(f"  {route}: 0 ok, {errors[route]} failed")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the gunicorn deployment at several worker counts")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4], help="Worker counts to measure")
+    parser.add_argument("--threads", type=int, default=16, help="Concurrent client threads")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per run")
+    parser.add_argument("--users", type=int, default=16, help="Test users to spread the load over")
+    args = parser.parse_args()
+    run_bench(args.workers, args.threads, args.duration, args.users)
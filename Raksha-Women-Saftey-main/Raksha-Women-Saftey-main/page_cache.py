@@ -0,0 +1,57 @@
+"""
+Versioned caching for per-user page data and rendered template fragments.
+
+Every cached entry's key includes the current version of the data it was
+built from ('contacts', 'zones', 'emergencies'). Write routes call bump()
+after committing, which makes entries built from the old data unreachable;
+they then simply expire. Entries live in the shared state backend so all
+workers see the same versions.
+"""
+
+import os
+import shared_state
+
+CACHE_TTL = float(os.getenv('PAGE_CACHE_TTL', 600))
+
+# Every data kind a cache entry can depend on
+KINDS = ('contacts', 'zones', 'emergencies')
+
+
+def version(kind, user_id):
+    return shared_state.get_backend().get(f"ver:{kind}:{user_id}", 0)
+
+
+def bump(kind, user_id):
+    """Invalidate everything cached from a user's `kind` data"""
+    shared_state.get_backend().incr(f"ver:{kind}:{user_id}")
+
+
+def bump_all(user_id):
+    """Invalidate everything cached for a user, e.g. after their rows moved and got new ids"""
+    for kind in KINDS:
+        bump(kind, user_id)
+
+
+def cached(name, user_id, depends_on, build, ttl=CACHE_TTL):
+    """
+    Return a cached value, building and storing it on a miss
+
+    Parameters:
+    name (str): Name of the cached item
+    user_id (int): Owner of the data
+    depends_on (list): Data kinds whose versions key the entry
+    build (callable): Builds the value (must be JSON serialisable)
+    ttl (float): Seconds to keep the entry
+
+    Returns:
+    The cached or freshly built value
+    """
+    backend = shared_state.get_backend()
+    versions = '.'.join(str(version(kind, user_id)) for kind in depends_on)
+    key = f"cache:{name}:{user_id}:{versions}"
+
+    value = backend.get(key)
+    if value is None:
+        value = build()
+        backend.set(key, value, ttl=ttl)
+    return value
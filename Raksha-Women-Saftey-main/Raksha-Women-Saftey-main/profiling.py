@@ -0,0 +1,231 @@
+"""
+Opt-in request profiling.
+
+Nothing is registered unless one of these is set, so the disabled cost is nil:
+
+    PROFILE_SAMPLE_RATE  fraction of requests to run under cProfile (e.g. 0.01)
+    PROFILE_SLOW_MS      capture any request slower than this many milliseconds
+
+Sampled requests get a cProfile report. With PROFILE_SLOW_MS set, in-flight
+requests are also stack-sampled every PROFILE_STACK_INTERVAL_MS, and the
+samples are kept only for requests that turn out slow. Both kinds of capture
+record every SQL statement with its duration.
+
+Captures are written as JSON to PROFILE_DIR (shared by all workers) and
+listed at /debug/profiles. They hold request paths and SQL from every
+user, so only admins (ADMIN_USERS, see admin.py) can read them.
+"""
+
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from flask import g, jsonify, abort, has_request_context, request
+from flask_login import login_required
+from admin import admin_required
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 200))
+PROFILE_STACK_INTERVAL_MS = float(os.getenv('PROFILE_STACK_INTERVAL_MS', 10))
+
+_ids = itertools.count()
+
+
+class StackSampler:
+    """Background thread that periodically records the stack of every registered request thread"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._threads = {}  # thread id -> Counter of folded stacks
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """Start the sampling thread in this process if it isn't running (threads don't survive a fork)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = {}
+        threading.Thread(target=self._run, name='stack-sampler', daemon=True).start()
+
+    def register(self, thread_id):
+        with self._lock:
+            self._threads[thread_id] = Counter()
+
+    def unregister(self, thread_id):
+        with self._lock:
+            return self._threads.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._threads:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stacks in self._threads.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[_fold(frame)] += 1
+
+
+def _fold(frame):
+    # Folded stack format (root first) as used by flamegraph tools
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ';'.join(reversed(parts))
+
+
+_sampler = StackSampler(PROFILE_STACK_INTERVAL_MS / 1000)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'profile' in g:
+        conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'profile' in g and conn.info.get('profile_started'):
+        started = conn.info['profile_started'].pop()
+        g.profile['sql'].append({
+            'statement': statement,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2)
+        })
+
+
+def _start_profile():
+    sampled = PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE
+    if not sampled and not PROFILE_SLOW_MS:
+        return
+
+    g.profile = {'started': time.perf_counter(), 'sql': [], 'profiler': None, 'thread': None}
+    if sampled:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.profile['profiler'] = profiler
+        except ValueError:
+            pass  # Another profiler is already active on this thread
+    if PROFILE_SLOW_MS:
+        # Started lazily so each gunicorn worker runs its own sampler (the app is preloaded in the master)
+        _sampler.start()
+        g.profile['thread'] = threading.get_ident()
+        _sampler.register(g.profile['thread'])
+
+
+def _finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+
+    duration_ms = (time.perf_counter() - profile['started']) * 1000
+    stacks = _sampler.unregister(profile['thread']) if profile['thread'] else None
+    profiler = profile['profiler']
+    if profiler:
+        profiler.disable()
+
+    slow = PROFILE_SLOW_MS and duration_ms >= PROFILE_SLOW_MS
+    if not (profiler or slow):
+        return response
+
+    record = {
+        'id': f"{int(time.time() * 1000)}-{os.getpid()}-{next(_ids)}",
+        'timestamp': time.time(),
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round(duration_ms, 1),
+        'reason': 'sampled' if profiler else 'slow',
+        'sql_count': len(profile['sql']),
+        'sql_ms': round(sum(query['duration_ms'] for query in profile['sql']), 2),
+        'sql': profile['sql']
+    }
+    if profiler:
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+        record['cprofile'] = out.getvalue()
+    if stacks:
+        record['stack_samples'] = [
+            {'stack': stack, 'count': count} for stack, count in stacks.most_common(50)
+        ]
+
+    try:
+        _save(record)
+    except OSError as e:
+        print(f"Error saving profile: {str(e)}")
+    return response
+
+
+def _save(record):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, f"{record['id']}.json"), 'w') as f:
+        json.dump(record, f)
+
+    files = sorted(os.listdir(PROFILE_DIR))
+    for name in files[:-PROFILE_KEEP]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            pass
+
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    summaries = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            continue
+        summaries.append({key: record[key] for key in (
+            'id', 'timestamp', 'method', 'path', 'status', 'duration_ms', 'reason', 'sql_count', 'sql_ms'
+        )})
+    return summaries
+
+
+def init_profiling(app):
+    """Register the profiling hooks and /debug/profiles routes if profiling is enabled"""
+    if not (PROFILE_SAMPLE_RATE or PROFILE_SLOW_MS):
+        return
+
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.route('/debug/profiles')
+    @login_required
+    @admin_required
+    def debug_profiles():
+        return jsonify(list_profiles())
+
+    @app.route('/debug/profiles/<profile_id>')
+    @login_required
+    @admin_required
+    def debug_profile(profile_id):
+        path = os.path.join(PROFILE_DIR, f"{os.path.basename(profile_id)}.json")
+        if not os.path.exists(path):
+            abort(404)
+        with open(path) as f:
+            return jsonify(json.load(f))
+
+    print(f"Profiling enabled: sample rate {PROFILE_SAMPLE_RATE}, slow threshold {PROFILE_SLOW_MS}ms, saving to {PROFILE_DIR}")
@@ -0,0 +1,225 @@
+"""
+Health tracking and routing for the alert delivery providers (Pushbullet, Twilio).
+
+Every provider has a circuit breaker fed by a rolling window of recent calls.
+send_with_failover() sends through the healthiest provider first, hedges to
+the next one if the first is slow, and skips providers whose circuit is open,
+so an outage at one provider no longer delays every SOS. A provider that
+only reached some of the contacts doesn't end the delivery: the next
+provider is started straight away.
+
+Health is tracked per worker process. Each worker learns about an outage from
+its own calls, which is enough to stop it waiting on a dead provider.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Start the next provider if the current one hasn't succeeded within this many seconds
+HEDGE_AFTER = float(os.getenv('ALERT_HEDGE_AFTER', 3))
+
+# Give up waiting for providers after this many seconds
+DELIVERY_TIMEOUT = float(os.getenv('ALERT_DELIVERY_TIMEOUT', 30))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ProviderHealth:
+    """Circuit breaker plus rolling latency/error window for one provider"""
+
+    def __init__(self, name, window=20, min_calls=4, failure_rate=0.5, open_seconds=30):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self._calls = deque(maxlen=window)  # (success, latency in seconds)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """Whether a call may go to this provider now. In half-open state one probe call is let through."""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if time.monotonic() - self._opened_at < self.open_seconds or self._probe_in_flight:
+                return False
+            self._state = HALF_OPEN
+            self._probe_in_flight = True
+            return True
+
+    def record(self, success, latency):
+        with self._lock:
+            self._calls.append((success, latency))
+            if self._state != CLOSED:
+                # A probe (or a forced call while open) decides the state on its own
+                self._probe_in_flight = False
+                if success:
+                    self._state = CLOSED
+                    self._calls.clear()
+                else:
+                    self._open()
+                return
+
+            failures = sum(1 for ok, _ in self._calls if not ok)
+            if len(self._calls) >= self.min_calls and failures / len(self._calls) >= self.failure_rate:
+                self._open()
+
+    def _open(self):
+        if self._state != OPEN:
+            print(f"Circuit opened for {self.name}")
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            calls = list(self._calls)
+        latencies = sorted(latency for _, latency in calls)
+        return {
+            'state': self.state,
+            'calls': len(calls),
+            'error_rate': sum(1 for ok, _ in calls if not ok) / len(calls) if calls else 0.0,
+            'p50_latency': latencies[len(latencies) // 2] if latencies else None
+        }
+
+    def score(self):
+        """Lower is healthier: mostly error rate, then median latency"""
+        stats = self.stats()
+        return stats['error_rate'] * 100 + (stats['p50_latency'] or 0)
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ALERT_WORKERS', 8)), thread_name_prefix='alert')
+
+
+def get_health(name):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = ProviderHealth(name)
+        return _registry[name]
+
+
+def _succeeded(result):
+    # Providers return a result dict; a bare bool is accepted too
+    if isinstance(result, dict):
+        return bool(result.get('success'))
+    return bool(result)
+
+
+def _reached_all(result):
+    """Whether a successful result reached every contact, judged by its per-contact 'results' if it has them"""
+    if not _succeeded(result):
+        return False
+    if isinstance(result, dict):
+        return all(item.get('success') for item in result.get('results', []))
+    return True
+
+
+def _timed_call(name, send):
+    health = get_health(name)
+    started = time.monotonic()
+    try:
+        result = send()
+    except Exception as e:
+        print(f"Error sending alert via {name}: {str(e)}")
+        result = {'success': False, 'message': str(e)}
+    health.record(_succeeded(result), time.monotonic() - started)
+    return result
+
+
+def send_with_failover(providers, hedge_after=HEDGE_AFTER, timeout=DELIVERY_TIMEOUT):
+    """
+    Deliver an alert through the healthiest available provider
+
+    Parameters:
+    providers (dict): Provider name -> zero-argument callable that sends the alert
+    hedge_after (float): Seconds to wait for a provider before also starting the next one
+    timeout (float): Seconds to wait in total before giving up
+
+    Returns:
+    dict: success (some contact was reached), complete (one provider reached
+          every contact), the provider that delivered first, per-provider
+          results for the calls that finished, and the providers attempted and skipped
+    """
+    queue = sorted(
+        (name for name in providers if get_health(name).state != OPEN),
+        key=lambda name: get_health(name).score()
+    )
+    skipped = [name for name in providers if name not in queue]
+    force = not queue
+    if force:
+        # Every circuit is open; trying anyway beats dropping an alert
+        queue, skipped = list(providers), []
+
+    pending = {}
+    results = {}
+    attempted = []
+    delivered_by = None
+    complete = False
+    hedge_now = False
+    deadline = time.monotonic() + timeout
+
+    while queue or pending:
+        if queue and (not pending or hedge_now or _hedge_due(pending, hedge_after)):
+            hedge_now = False
+            name = queue.pop(0)
+            # allow() is only asked right before a call so a half-open probe is never left hanging
+            if not force and not get_health(name).allow():
+                skipped.append(name)
+                continue
+            attempted.append(name)
+            pending[_executor.submit(_timed_call, name, providers[name])] = (name, time.monotonic())
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        wait_for = min(remaining, hedge_after) if queue else remaining
+        done, _ = wait(list(pending), timeout=wait_for, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            name, _ = pending.pop(future)
+            results[name] = future.result()
+            if _succeeded(results[name]) and delivered_by is None:
+                delivered_by = name
+            if _reached_all(results[name]):
+                complete = True
+            elif _succeeded(results[name]):
+                # Some contacts weren't reached, so don't wait for the hedge timer to try the next provider
+                print(f"{name} reached only some contacts, trying the next provider")
+                hedge_now = True
+        if complete:
+            break
+
+    return {
+        'success': delivered_by is not None,
+        'complete': complete,
+        'provider': delivered_by,
+        'results': results,
+        'attempted': attempted,
+        'skipped': skipped
+    }
+
+
+def _hedge_due(pending, hedge_after):
+    now = time.monotonic()
+    return all(now - started >= hedge_after for _, started in pending.values())
+
+
+def health_report():
+    with _registry_lock:
+        names = list(_registry)
+    return {name: get_health(name).stats() for name in names}
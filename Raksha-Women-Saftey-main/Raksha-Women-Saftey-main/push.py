@@ -3,20 +3,27 @@
 import requests
 import json
 import argparse
+import csv
+import hashlib
+import io
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
 
-def send_sms_via_pushbullet(api_key, device_iden, number, message):
-    """
-    Send SMS message using Pushbullet's API
-    
-    Parameters:
-    api_key (str): Your Pushbullet API key
-    device_iden (str): The identifier of the device you want to send from
-    number (str): The phone number you want to send the SMS to
-    message (str): The message content
-    """
-    
-    # Pushbullet API endpoint for sending SMS
-    url = "https://api.pushbullet.com/v2/texts"
+PUSHBULLET_API = os.getenv("PUSHBULLET_API_URL", "https://api.pushbullet.com/v2")
+
+# Device list cache, shared by every push.py run on this machine
+DEVICE_CACHE_FILE = os.getenv("PUSHBULLET_DEVICE_CACHE", ".pushbullet_devices.json")
+DEVICE_CACHE_TTL = float(os.getenv("PUSHBULLET_DEVICE_TTL", 600))
+# Statuses Pushbullet returns when a device is unknown or gone
+DEVICE_ERRORS = (400, 404, 410)
+
+def post_text(api_key, device_iden, number, message, session=None, base_url=PUSHBULLET_API):
+    """Make the /texts API request and return the response"""
     
     # Headers including authorization
     headers = {
@@ -33,8 +40,21 @@ def send_sms_via_pushbullet(api_key, device_iden, number, message):
         }
     }
     
+    return (session or requests).post(f"{base_url}/texts", headers=headers, data=json.dumps(data), timeout=30)
+
+def send_sms_via_pushbullet(api_key, device_iden, number, message):
+    """
+    Send SMS message using Pushbullet's API
+    
+    Parameters:
+    api_key (str): Your Pushbullet API key
+    device_iden (str): The identifier of the device you want to send from
+    number (str): The phone number you want to send the SMS to
+    message (str): The message content
+    """
+    
     # Make the API request
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = post_text(api_key, device_iden, number, message)
     
     # Check if request was successful
     if response.status_code == 200:
@@ -45,16 +65,20 @@ def send_sms_via_pushbullet(api_key, device_iden, number, message):
         print(f"Response: {response.text}")
         return False
 
+def fetch_devices(api_key, session=None, base_url=PUSHBULLET_API):
+    """Fetch the raw device list, or None if the request failed"""
+    response = (session or requests).get(f"{base_url}/devices", headers={"Access-Token": api_key}, timeout=30)
+    if response.status_code != 200:
+        print(f"Failed to retrieve devices. Status code: {response.status_code}", file=sys.stderr)
+        return None
+    return response.json().get("devices", [])
+
 def list_devices(api_key):
     """List all available devices in your Pushbullet account"""
     
-    url = "https://api.pushbullet.com/v2/devices"
-    headers = {"Access-Token": api_key}
+    devices = fetch_devices(api_key)
     
-    response = requests.get(url, headers=headers)
-    
-    if response.status_code == 200:
-        devices = response.json().get("devices", [])
+    if devices is not None:
         print("Available devices:")
         for device in devices:
             if device.get("active"):
@@ -64,25 +88,325 @@ def list_devices(api_key):
                 print("  ---")
         return devices
     else:
-        print(f"Failed to retrieve devices. Status code: {response.status_code}")
         return []
 
+class DeviceRegistry:
+    """
+    Cached list of the account's active SMS-capable devices
+
+    The list is kept in memory and in DEVICE_CACHE_FILE so short-lived
+    push.py runs share it. Once it is older than the TTL it is fetched again
+    before use (once per registry). A long-lived process can pass
+    background=True to keep using the old list while a background thread
+    refreshes it; a push.py run would exit before that thread finished.
+    A device that fails a send is dropped by invalidate(), which fetches the
+    list again. next_device() spreads sends round-robin over all SMS devices
+    to get past per-device rate limits.
+    """
+
+    def __init__(self, api_key, ttl=DEVICE_CACHE_TTL, cache_file=DEVICE_CACHE_FILE,
+                 session=None, base_url=PUSHBULLET_API, background=False):
+        self.api_key = api_key
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.session = session
+        self.base_url = base_url
+        self.background = background
+        # The cache file is keyed by a hash so the API key is never written to disk
+        self._cache_key = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+        self._devices = None
+        self._fetched_at = 0.0
+        self._next = 0
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._refreshing = False
+        self._refreshed = False
+        self._invalidated = set()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as f:
+                entry = json.load(f).get(self._cache_key)
+        except (OSError, ValueError):
+            return
+        if entry:
+            self._devices = entry["devices"]
+            self._fetched_at = entry["fetched_at"]
+
+    def _save(self):
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        cache[self._cache_key] = {"fetched_at": self._fetched_at, "devices": self._devices}
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            print(f"Could not write device cache: {e}", file=sys.stderr)
+
+    def refresh(self):
+        """
+        Fetch the device list now. Keeps the old list if the request fails.
+
+        Returns:
+        bool: True if the list was fetched
+        """
+        try:
+            devices = fetch_devices(self.api_key, self.session, self.base_url)
+        except requests.RequestException as e:
+            print(f"Failed to retrieve devices: {e}", file=sys.stderr)
+            devices = None
+        with self._lock:
+            self._refreshing = False
+            self._refreshed = True
+            if devices is None:
+                return False
+            self._devices = [
+                {"iden": device["iden"], "nickname": device.get("nickname", "Unknown")}
+                for device in devices
+                if device.get("active") and device.get("has_sms")
+            ]
+            self._fetched_at = time.time()
+            self._save()
+            return True
+
+    def sms_devices(self):
+        """Return the cached SMS-capable devices, refreshing them if needed"""
+        with self._lock:
+            devices = self._devices
+            stale = time.time() - self._fetched_at >= self.ttl
+            start_background = self.background and devices is not None and stale and not self._refreshing
+            if start_background:
+                self._refreshing = True
+
+        if start_background:
+            threading.Thread(target=self.refresh, name="device-refresh", daemon=True).start()
+            return devices
+        if devices is None or stale:
+            # Only the first caller fetches; concurrent callers wait for its result
+            with self._fetch_lock:
+                if self._devices is None or not self._refreshed:
+                    self.refresh()
+        return self._devices or []
+
+    def invalidate(self, device_iden=None):
+        """
+        Drop a device that failed a send and fetch the list again.
+        Each device is only refetched for once, so sends that fail for
+        another reason don't fetch the list on every message.
+
+        Returns:
+        bool: True if the list was fetched again
+        """
+        with self._fetch_lock:
+            if device_iden in self._invalidated:
+                return False
+            self._invalidated.add(device_iden)
+            with self._lock:
+                if self._devices is not None:
+                    self._devices = [device for device in self._devices if device["iden"] != device_iden]
+                # Marked stale on disk too, so the next run refetches even if this fetch fails
+                self._fetched_at = 0.0
+                self._save()
+            print(f"Device {device_iden} failed, fetching the device list again", file=sys.stderr)
+            return self.refresh()
+
+    def next_device(self):
+        """Pick the next SMS device round-robin, or None if there is none"""
+        devices = self.sms_devices()
+        if not devices:
+            return None
+        with self._lock:
+            device = devices[self._next % len(devices)]
+            self._next += 1
+        return device["iden"]
+
+def read_batch(source):
+    """
+    Read batch recipients from a file or stdin ("-")
+
+    Accepts a JSON list, NDJSON (one object per line) or CSV with a header row.
+    Each entry needs "number" and "message" and may set "device" and "id".
+
+    Returns:
+    list: The batch entries
+    """
+    if source == "-":
+        text = sys.stdin.read()
+    else:
+        with open(source, newline="") as f:
+            text = f.read()
+
+    stripped = text.lstrip()
+    if source.endswith(".csv") or not stripped.startswith(("[", "{")):
+        return list(csv.DictReader(io.StringIO(text)))
+    if stripped.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def send_batch(api_key, device_iden, entries, concurrency=8, base_url=PUSHBULLET_API, out=sys.stdout):
+    """
+    Send many SMS messages over one pooled session
+
+    Results are written to `out` as NDJSON, one line per message as it finishes.
+
+    Parameters:
+    api_key (str): Your Pushbullet API key
+    device_iden (str): Default device to send from (entries may override it).
+        None or "auto" spreads the messages over the account's SMS devices.
+    entries (list): Dicts with "number" and "message" (and optionally "device", "id")
+    concurrency (int): Maximum requests in flight
+    base_url (str): Pushbullet API base URL
+
+    Returns:
+    dict: Counts and latencies for the whole batch
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+    write_lock = threading.Lock()
+    registry = None
+    if device_iden in (None, "auto"):
+        registry = DeviceRegistry(api_key, session=session, base_url=base_url)
+
+    def send(index, entry):
+        started = time.perf_counter()
+        result = {"index": index, "number": entry.get("number")}
+        if "id" in entry:
+            result["id"] = entry["id"]
+        try:
+            device = entry.get("device") or (registry.next_device() if registry else device_iden)
+            if not device and registry and registry.invalidate():
+                device = registry.next_device()
+            if not device:
+                raise ValueError("No SMS-capable Pushbullet device found")
+            result["device"] = device
+            response = post_text(
+                api_key, device, entry["number"], entry["message"],
+                session=session, base_url=base_url
+            )
+            if response.status_code in DEVICE_ERRORS and registry and not entry.get("device"):
+                # The device may have been removed since the list was cached; retry once on a fresh list
+                registry.invalidate(device)
+                retry_device = registry.next_device()
+                if retry_device:
+                    result["device"] = retry_device
+                    result["retried"] = True
+                    response = post_text(
+                        api_key, retry_device, entry["number"], entry["message"],
+                        session=session, base_url=base_url
+                    )
+            result["success"] = response.status_code == 200
+            result["status"] = response.status_code
+            if not result["success"]:
+                result["error"] = response.text[:500]
+        except Exception as e:
+            result["success"] = False
+            result["error"] = str(e)
+        result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return result
+
+    started = time.perf_counter()
+    latencies = []
+    sent = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(send, index, entry) for index, entry in enumerate(entries)]
+        for future in as_completed(futures):
+            result = future.result()
+            latencies.append(result["elapsed_ms"])
+            sent += result["success"]
+            with write_lock:
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+    session.close()
+
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "total": len(entries),
+        "sent": sent,
+        "failed": len(entries) - sent,
+        "seconds": round(elapsed, 3),
+        "per_second": round(len(entries) / elapsed, 1) if elapsed else None,
+        "p50_ms": latencies[len(latencies) // 2] if latencies else None,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else None
+    }
+
+def run_bench(count, concurrency, latency_ms):
+    """Measure batch throughput against a local stub of the Pushbullet API"""
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency_ms / 1000)
+            body = b'{"data": {}}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class StubServer(ThreadingHTTPServer):
+        daemon_threads = True
+        request_queue_size = 128  # The default backlog of 5 stalls connects under load
+
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v2"
+
+    entries = [{"number": f"+9100000{i:05d}", "message": f"bench message {i}"} for i in range(count)]
+    with open(os.devnull, "w") as devnull:
+        summary = send_batch("bench-key", "bench-device", entries, concurrency, base_url, out=devnull)
+    server.shutdown()
+
+    print(f"Sent {summary['sent']}/{summary['total']} messages in {summary['seconds']}s "
+          f"({summary['per_second']} msg/s) with concurrency {concurrency} and {latency_ms}ms stub latency")
+    print(f"Latency p50 {summary['p50_ms']}ms, p99 {summary['p99_ms']}ms")
+    return summary
+
 if __name__ == "__main__":
     # Set up command line argument parsing
     parser = argparse.ArgumentParser(description="Send SMS messages via Pushbullet")
-    parser.add_argument("--api-key", required=True, help="Your Pushbullet API key")
+    parser.add_argument("--api-key", help="Your Pushbullet API key")
     parser.add_argument("--list-devices", action="store_true", help="List available devices")
-    parser.add_argument("--device", help="Device identifier to send from")
+    parser.add_argument("--device", help="Device identifier to send from (\"auto\" picks SMS-capable devices)")
     parser.add_argument("--number", help="Phone number to send SMS to")
     parser.add_argument("--message", help="Message content to send")
+    parser.add_argument("--batch", metavar="FILE", help="Send to many numbers from a JSON, NDJSON or CSV file (- for stdin)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum requests in flight in batch mode")
+    parser.add_argument("--bench", type=int, metavar="N", help="Send N messages to a local stub server and report throughput")
+    parser.add_argument("--bench-latency", type=float, default=50, help="Stub server latency in milliseconds")
     
     args = parser.parse_args()
     
-    if args.list_devices:
+    if args.bench:
+        run_bench(args.bench, args.concurrency, args.bench_latency)
+    elif not args.api_key:
+        parser.error("--api-key is required")
+    elif args.list_devices:
         list_devices(args.api_key)
+    elif args.batch:
+        summary = send_batch(args.api_key, args.device, read_batch(args.batch), args.concurrency)
+        # Keep stdout pure NDJSON; the summary goes to stderr
+        print(json.dumps(summary), file=sys.stderr)
+        sys.exit(0 if summary["sent"] else 1)
     elif args.device and args.number and args.message:
-        send_sms_via_pushbullet(args.api_key, args.device, args.number, args.message)
+        device = args.device
+        if device == "auto":
+            device = DeviceRegistry(args.api_key).next_device()
+        if device:
+            send_sms_via_pushbullet(args.api_key, device, args.number, args.message)
+        else:
+            print("Error: No SMS-capable Pushbullet device found")
     else:
         if not args.list_devices:
-            print("Error: You must either use --list-devices or provide --device, --number, and --message")
+            print("Error: You must either use --list-devices, --batch, or provide --device, --number, and --message")
             parser.print_help()
\ No newline at end of file
@@ -0,0 +1,125 @@
+"""
+Token bucket rate limiting for expensive routes.
+
+Buckets are kept in the shared state backend (see shared_state.py) so a limit
+holds across all worker processes. Each limited route has a bucket per user
+and one bucket for the route as a whole.
+"""
+
+import asyncio
+import os
+import time
+from functools import wraps
+from flask import jsonify
+from flask_login import current_user
+import shared_state
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+
+# A user's first SOS in this window is never rate limited
+SOS_EXEMPT_WINDOW = float(os.getenv('SOS_EXEMPT_WINDOW', 3600))
+
+
+def take_token(key, rate, capacity, cost=1, backend=None):
+    """
+    Try to take tokens from a bucket
+
+    Parameters:
+    key (str): Bucket key in the shared state backend
+    rate (float): Tokens added per second
+    capacity (float): Maximum tokens the bucket holds (the burst size)
+    cost (float): Tokens this request needs
+    backend (optional): Shared state backend, defaults to the process-wide one
+
+    Returns:
+    tuple: (allowed, retry_after) where retry_after is in seconds
+    """
+    backend = backend or shared_state.get_backend()
+
+    def refill_and_take(state):
+        now = time.time()
+        tokens, updated_at = state if state else (capacity, now)
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        if tokens >= cost:
+            return [tokens - cost, now], (True, 0.0)
+        return [tokens, now], (False, (cost - tokens) / rate)
+
+    # Once the bucket would be full again the entry can expire
+    return backend.update(key, refill_and_take, ttl=capacity / rate + 1)
+
+
+def refund_token(key, rate, capacity, cost=1, backend=None):
+    """Give back tokens taken by take_token() for a request that was denied by another bucket"""
+    backend = backend or shared_state.get_backend()
+
+    def refill_and_refund(state):
+        now = time.time()
+        tokens, updated_at = state if state else (capacity, now)
+        tokens = min(capacity, tokens + (now - updated_at) * rate + cost)
+        return [tokens, now], None
+
+    backend.update(key, refill_and_refund, ttl=capacity / rate + 1)
+
+
+def rate_limited(route, per_user, per_route=None, first_sos_exempt=False):
+    """
+    Decorator that rate limits a login-protected view
+
+    Parameters:
+    route (str): Name used in the bucket keys
+    per_user (tuple): (requests, seconds) allowed per user
+    per_route (tuple, optional): (requests, seconds) allowed for all users together
+    first_sos_exempt (bool or callable): Always let a user's first request per
+        SOS_EXEMPT_WINDOW through. A callable is asked per request, so only
+        requests it returns True for use up (and get) the pass.
+
+    Apply it below @login_required so current_user is known.
+    """
+    buckets = [('user', per_user)]
+    if per_route:
+        buckets.append(('route', per_route))
+
+    def check():
+        # Anonymous requests are left to the view's own login check
+        if not RATE_LIMIT_ENABLED or not current_user.is_authenticated:
+            return None
+
+        backend = shared_state.get_backend()
+        user_id = current_user.get_id()
+
+        exempt = first_sos_exempt() if callable(first_sos_exempt) else first_sos_exempt
+        if exempt and backend.add(f"rl:first:{route}:{user_id}", 1, ttl=SOS_EXEMPT_WINDOW):
+            return None
+
+        taken = []
+        for scope, (requests, seconds) in buckets:
+            key = f"rl:{scope}:{route}:{user_id}" if scope == 'user' else f"rl:{scope}:{route}"
+            allowed, retry_after = take_token(key, requests / seconds, requests, backend=backend)
+            if not allowed:
+                # The request doesn't go through, so it shouldn't cost the buckets that allowed it
+                for taken_key, taken_requests, taken_seconds in taken:
+                    refund_token(taken_key, taken_requests / taken_seconds, taken_requests, backend=backend)
+                print(f"Rate limit hit on {route} ({scope}) for user {user_id}")
+                response = jsonify({
+                    'error': 'Too many requests, please try again shortly',
+                    'retry_after': round(retry_after, 1)
+                })
+                response.status_code = 429
+                response.headers['Retry-After'] = str(max(1, int(retry_after + 0.5)))
+                return response
+            taken.append((key, requests, seconds))
+        return None
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                return check() or await view(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return check() or view(*args, **kwargs)
+        return wrapper
+
+    return decorator
@@ -0,0 +1,359 @@
+"""
+Sharded storage by user.
+
+Every query on per-user data is already scoped by user_id, so a user's
+Contact, SafetyZone, EmergencyHistory and Location rows (and their analytics
+rollups) can live in one of several databases. The shard is picked with a
+jump consistent hash of the user id; adding a shard only moves about 1/N of
+the users. Shard 0 is the main database, which also keeps the User table as
+the global directory used for logins.
+
+    SHARD_COUNT         number of shards (default 1, i.e. everything in the main database)
+    SHARD_URL_TEMPLATE  URL for shards 1..N-1 (default sqlite:///women_safety.shard{n}.db)
+    SHARD_URLS          comma-separated URLs for shards 1..N-1, instead of the template
+
+Shards must be SQLite databases: the analytics rollups are written with
+SQLite upserts and resharding relies on SQLite's locking.
+
+Sharding spreads data over files; it only adds write throughput when the
+shards sit on separate disks (or hosts) with cores to spare. On one disk
+and core `--bench` measured the opposite, 1342 commits/s with one shard,
+574 with two and 282 with four, so measure on the real layout first.
+
+Sharded queries go to the shard of the logged-in user. Code that runs
+outside a request (or for another user) wraps its queries in
+user_context(user_id). Row ids are only unique within a shard.
+
+After changing the shard settings, create the new tables with
+`python init_db.py` and move existing users with the command below. Each
+user is moved under a write lock on their old shard, so app writes that
+arrive mid-move wait instead of being deleted with the copied rows. It
+invalidates the moved users' cached pages in the shared state backend;
+with the in-memory backend, restart the app instead.
+
+    python sharding.py --reshard --from sqlite:///women_safety.db
+    python sharding.py --bench                 # write throughput by shard count
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import current_app, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import MetaData, Table, and_, bindparam, create_engine, inspect, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.util import find_tables
+import analytics
+import page_cache
+import shared_state
+
+SHARD_URL_TEMPLATE = os.getenv('SHARD_URL_TEMPLATE', 'sqlite:///women_safety.shard{n}.db')
+SHARD_URLS = [url.strip() for url in os.getenv('SHARD_URLS', '').split(',') if url.strip()]
+SHARD_COUNT = len(SHARD_URLS) + 1 if SHARD_URLS else int(os.getenv('SHARD_COUNT', 1))
+
+# Tables holding one user's rows, keyed by a user_id column
+USER_TABLES = (
+    'contact', 'safety_zone', 'emergency_history', 'location', 'emergency_user_daily', 'emergency_resolution', 'sync_cursor'
+)
+# Regional rollups are spread over all shards and merged when read
+SHARDED_TABLES = USER_TABLES + ('emergency_cell_hourly',)
+
+_user_id = ContextVar('shard_user_id', default=None)
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash (Lamping & Veach): map an integer key to one of `buckets`"""
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def shard_for(user_id, count=SHARD_COUNT):
+    return jump_hash(int(user_id), count)
+
+
+def bind_key(shard):
+    """Flask-SQLAlchemy bind name for a shard (shard 0 is the default database)"""
+    return None if shard == 0 else f"shard{shard}"
+
+
+def shard_binds():
+    """SQLALCHEMY_BINDS entries for shards 1..N-1"""
+    urls = SHARD_URLS or [SHARD_URL_TEMPLATE.format(n=n) for n in range(1, SHARD_COUNT)]
+    for url in urls:
+        # The analytics upserts and resharding use SQLite-only SQL
+        if not url.startswith('sqlite:'):
+            raise RuntimeError(f"Shard {url} is not a SQLite database; only SQLite shards are supported")
+    return {bind_key(n): url for n, url in enumerate(urls, start=1)}
+
+
+@contextmanager
+def user_context(user_id):
+    """Route sharded queries in this block to `user_id`'s shard"""
+    token = _user_id.set(user_id)
+    try:
+        yield
+    finally:
+        _user_id.reset(token)
+
+
+def current_user_id():
+    user_id = _user_id.get()
+    if user_id is None and has_request_context() and hasattr(current_app, 'login_manager'):
+        from flask_login import current_user
+        if current_user.is_authenticated:
+            user_id = current_user.id
+    return user_id
+
+
+def _sharded_table(mapper, clause):
+    if mapper is not None:
+        tables = [mapper.persist_selectable]
+    elif clause is not None:
+        tables = find_tables(clause, include_crud=True)
+    else:
+        return None
+    for table in tables:
+        if getattr(table, 'name', None) in SHARDED_TABLES:
+            return table
+    return None
+
+
+class ShardedSession(SignallingSession):
+    """Session that sends per-user tables to the current user's shard"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if SHARD_COUNT > 1 and _sharded_table(mapper, clause) is not None:
+            user_id = current_user_id()
+            if user_id is None:
+                raise RuntimeError("Sharded query without a user; wrap it in sharding.user_context(user_id)")
+            return get_state(self.app).db.get_engine(self.app, bind=bind_key(shard_for(user_id)))
+        return super().get_bind(mapper, clause)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=ShardedSession, db=self, **options)
+
+
+def engine_for(db, user_id):
+    """Engine holding `user_id`'s rows"""
+    return db.get_engine(bind=bind_key(shard_for(user_id)))
+
+
+def engines(db):
+    """Engines of every shard, shard 0 first"""
+    return [db.get_engine(bind=bind_key(n)) for n in range(SHARD_COUNT)]
+
+
+def create_all(db):
+    """Create the directory and all tables in the main database, and the per-user tables in every other shard"""
+    db.create_all()
+    tables = [table for table in db.Model.metadata.sorted_tables if table.name in SHARDED_TABLES]
+    for engine in engines(db):
+        db.Model.metadata.create_all(engine, tables=tables)
+        analytics.create_tables(engine)
+
+
+def _copy_user(source, dest, user_id):
+    """
+    Move one user's rows between shards. Ids are reassigned, since they are only unique per shard.
+
+    The source stays write-locked from the first read until the copied rows
+    are deleted, so the app can't add or update any of them in between, and
+    only the rows that were copied (by primary key) are deleted.
+    """
+    source_tables = set(inspect(source).get_table_names())
+    tables = [Table(name, MetaData(), autoload_with=source, resolve_fks=False)
+              for name in USER_TABLES if name in source_tables]
+    moved = 0
+    with source.connect() as src_conn, src_conn.begin():
+        # pysqlite would only start the transaction at the first write; take the write lock up front
+        src_conn.exec_driver_sql('BEGIN IMMEDIATE')
+        copied = {}
+        with dest.begin() as dest_conn:
+            for table in tables:
+                rows = [dict(row._mapping) for row in src_conn.execute(select(table).where(table.c.user_id == user_id))]
+                if not rows:
+                    continue
+                key_columns = list(table.primary_key.columns) or list(table.columns)
+                copied[table] = [{f"key_{column.name}": row[column.name] for column in key_columns} for row in rows]
+                if table.name == 'emergency_user_daily':
+                    for row in rows:
+                        dest_conn.execute(insert(analytics.user_daily).values(**row).on_conflict_do_update(
+                            index_elements=['user_id', 'day'],
+                            set_={
+                                'count': analytics.user_daily.c.count + row['count'],
+                                'resolved_count': analytics.user_daily.c.resolved_count + row['resolved_count'],
+                                'resolve_seconds': analytics.user_daily.c.resolve_seconds + row['resolve_seconds']
+                            }
+                        ))
+                else:
+                    for row in rows:
+                        row.pop('id', None)
+                    dest_conn.execute(table.insert(), rows)
+                moved += len(rows)
+        # Only delete once the copy has committed; a crash in between leaves a duplicate, never a loss
+        for table, keys in copied.items():
+            key_columns = list(table.primary_key.columns) or list(table.columns)
+            src_conn.execute(table.delete().where(and_(
+                *(column == bindparam(f"key_{column.name}") for column in key_columns)
+            )), keys)
+    # Cached pages and fragments still hold the old ids
+    page_cache.bump_all(user_id)
+    return moved
+
+
+def _move_cells(source, dest):
+    if 'emergency_cell_hourly' not in inspect(source).get_table_names():
+        return
+    table = analytics.cell_hourly
+    with source.connect() as src_conn, dest.begin() as dest_conn:
+        for row in src_conn.execute(select(table)):
+            dest_conn.execute(insert(table).values(**row._mapping).on_conflict_do_update(
+                index_elements=['cell', 'hour'], set_={'count': table.c.count + row.count}
+            ))
+    with source.begin() as src_conn:
+        src_conn.execute(table.delete())
+
+
+def reshard(source_urls, target_urls, dry_run=False):
+    """
+    Move users to the shard the current layout assigns them
+
+    Parameters:
+    source_urls (list): Databases that may hold user rows (e.g. the old layout)
+    target_urls (list): The new layout, shard 0 first. Its tables must exist.
+    dry_run (bool): Only report what would move
+
+    Returns:
+    dict: Users and rows moved
+    """
+    engines_by_url = {}
+
+    def engine(url):
+        if url not in engines_by_url:
+            engines_by_url[url] = create_engine(url, connect_args={'timeout': 30})
+        return engines_by_url[url]
+
+    for url in target_urls:
+        missing = set(SHARDED_TABLES) - set(inspect(engine(url)).get_table_names())
+        if missing:
+            raise RuntimeError(f"{url} is missing tables {sorted(missing)}; run init_db.py with the new shard settings first")
+
+    users = rows = 0
+    for url in dict.fromkeys(source_urls + target_urls):
+        source = engine(url)
+        source_tables = set(inspect(source).get_table_names())
+        user_ids = set()
+        with source.connect() as conn:
+            for name in USER_TABLES:
+                if name in source_tables:
+                    table = Table(name, MetaData(), autoload_with=source, resolve_fks=False)
+                    user_ids.update(row[0] for row in conn.execute(select(table.c.user_id).distinct()))
+
+        for user_id in sorted(user_ids):
+            target_url = target_urls[jump_hash(user_id, len(target_urls))]
+            if target_url == url:
+                continue
+            users += 1
+            if dry_run:
+                print(f"Would move user {user_id}: {url} -> {target_url}")
+            else:
+                rows += _copy_user(source, engine(target_url), user_id)
+
+        if url not in target_urls and not dry_run:
+            _move_cells(source, engine(target_urls[0]))
+
+    for created in engines_by_url.values():
+        created.dispose()
+    print(f"{'Would move' if dry_run else 'Moved'} {users} users ({rows} rows)")
+    return {'users': users, 'rows': rows}
+
+
+def _bench_worker(args):
+    urls, inserts, seed = args
+    rng = random.Random(seed)
+    shard_engines = [create_engine(url, connect_args={'timeout': 60}) for url in urls]
+    connections = [engine.connect() for engine in shard_engines]
+    table = Table('location', MetaData(), autoload_with=shard_engines[0])
+    for _ in range(inserts):
+        user_id = rng.randrange(1, 100000)
+        conn = connections[jump_hash(user_id, len(urls))]
+        with conn.begin():
+            conn.execute(table.insert(), {'latitude': 12.9, 'longitude': 77.5, 'address': 'Bench', 'user_id': user_id})
+    for conn in connections:
+        conn.close()
+
+
+def run_bench(shard_counts=(1, 2, 4), processes=8, inserts=300):
+    """
+    Measure single-row commit throughput of concurrent writer processes for each shard count.
+    All shards are created in one temporary directory, so this measures one disk; point the
+    shard files at separate disks to see whether they add throughput on a given host.
+    """
+    from sqlalchemy import Column, Integer, Float, String
+
+    for count in shard_counts:
+        with tempfile.TemporaryDirectory() as work_dir:
+            urls = [f"sqlite:///{os.path.join(work_dir, f'shard{n}.db')}" for n in range(count)]
+            for url in urls:
+                engine = create_engine(url)
+                with engine.begin() as conn:
+                    conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+                metadata = MetaData()
+                Table('location', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('latitude', Float, nullable=False),
+                      Column('longitude', Float, nullable=False),
+                      Column('address', String(200)),
+                      Column('user_id', Integer, nullable=False))
+                metadata.create_all(engine)
+                engine.dispose()
+
+            started = time.perf_counter()
+            with multiprocessing.Pool(processes) as pool:
+                pool.map(_bench_worker, [(urls, inserts, seed) for seed in range(processes)])
+            elapsed = time.perf_counter() - started
+
+            per_shard = []
+            for url in urls:
+                engine = create_engine(url)
+                with engine.connect() as conn:
+                    per_shard.append(conn.exec_driver_sql('SELECT COUNT(*) FROM location').scalar())
+                engine.dispose()
+            print(f"{count} shard(s): {processes * inserts / elapsed:.0f} commits/s "
+                  f"({processes} writer processes x {inserts} inserts, rows per shard {per_shard})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move users between shards, or benchmark sharded writes")
+    parser.add_argument("--reshard", action="store_true", help="Move users to the shard the current settings assign them")
+    parser.add_argument("--main-db", default="sqlite:///women_safety.db", help="URL of shard 0 (the main database)")
+    parser.add_argument("--from", dest="sources", default="", help="Comma-separated URLs of databases from the old layout")
+    parser.add_argument("--dry-run", action="store_true", help="Only report which users would move")
+    parser.add_argument("--bench", action="store_true", help="Benchmark write throughput by shard count")
+    parser.add_argument("--processes", type=int, default=8, help="Writer processes for the benchmark")
+    parser.add_argument("--inserts", type=int, default=300, help="Inserts per writer process")
+    args = parser.parse_args()
+
+    if args.bench:
+        run_bench(processes=args.processes, inserts=args.inserts)
+    elif args.reshard:
+        # Cache versions are bumped for moved users, so use the backend the workers share (see wsgi.py)
+        shared_state.set_backend(shared_state.create_backend(os.getenv('SHARED_STATE_BACKEND', 'sqlite')))
+        targets = [args.main_db] + list(shard_binds().values())
+        sources = [url.strip() for url in args.sources.split(',') if url.strip()]
+        reshard(sources, targets, args.dry_run)
+    else:
+        parser.print_help()
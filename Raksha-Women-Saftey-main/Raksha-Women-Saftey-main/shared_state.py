@@ -0,0 +1,216 @@
+"""
+Shared state backends for caches, dedup windows and rate limits.
+
+When the app runs under several worker processes (see wsgi.py) a module-level
+dict would give every worker its own copy of the state. Anything that must
+agree across workers goes through one of these backends instead.
+
+Backends:
+    memory - process-local dict, the default for `python app.py`
+    sqlite - a small SQLite file shared by all workers on one host
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class MemoryBackend:
+    """Process-local backend. Fine for a single process, not for multiple workers."""
+
+    PURGE_EVERY = 1000
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+        self._writes = 0
+
+    def _live(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def _store(self, key, value, ttl, now):
+        # Called with the lock held. Keys that are never read again (old cache
+        # versions, idle rate limit buckets) are only dropped by the periodic purge.
+        self._data[key] = (value, now + ttl if ttl else None)
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            expired = [k for k, (_, expires_at) in self._data.items() if expires_at is not None and expires_at <= now]
+            for k in expired:
+                del self._data[k]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._live(key, time.time())
+            return entry[0] if entry else default
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl, time.time())
+
+    def add(self, key, value, ttl=None):
+        """Set key only if it is missing or expired. Returns True if it was set."""
+        with self._lock:
+            now = time.time()
+            if self._live(key, now):
+                return False
+            self._store(key, value, ttl, now)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, amount=1, ttl=None):
+        return self.update(key, lambda current: ((current or 0) + amount,) * 2, ttl)
+
+    def update(self, key, fn, ttl=None):
+        """
+        Atomically read-modify-write a key
+
+        Parameters:
+        key (str): The key to update
+        fn (callable): Called with the current value (or None); returns (new_value, result)
+        ttl (float, optional): Expiry for the new value in seconds
+
+        Returns:
+        The `result` part of fn's return value
+        """
+        with self._lock:
+            now = time.time()
+            entry = self._live(key, now)
+            new_value, result = fn(entry[0] if entry else None)
+            self._store(key, new_value, ttl, now)
+            return result
+
+
+class SQLiteBackend:
+    """Backend stored in a SQLite file so every worker process on the host sees the same state."""
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS shared_state ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+
+    def _connection(self):
+        # Connections must not cross a fork or a thread boundary
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _read(self, conn, key, now):
+        row = conn.execute(
+            "SELECT value FROM shared_state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, now)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, conn, key, value, ttl, now):
+        conn.execute(
+            "INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), now + ttl if ttl else None)
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM shared_state WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+
+    def get(self, key, default=None):
+        value = self._read(self._connection(), key, time.time())
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        self._write(self._connection(), key, value, ttl, time.time())
+
+    def add(self, key, value, ttl=None):
+        """Set key only if it is missing or expired. Returns True if it was set."""
+        def fn(current):
+            if current is not None:
+                return None, False, False
+            return value, True, True
+        return self._transaction(key, fn, ttl)
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM shared_state WHERE key = ?", (key,))
+
+    def incr(self, key, amount=1, ttl=None):
+        return self.update(key, lambda current: ((current or 0) + amount,) * 2, ttl)
+
+    def update(self, key, fn, ttl=None):
+        """Atomically read-modify-write a key across processes. See MemoryBackend.update."""
+        return self._transaction(key, lambda current: fn(current) + (True,), ttl)
+
+    def _transaction(self, key, fn, ttl):
+        # fn returns (new_value, result, should_write)
+        conn = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front so two workers
+        # cannot both read the old value
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            new_value, result, should_write = fn(self._read(conn, key, now))
+            if should_write:
+                self._write(conn, key, new_value, ttl, now)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+
+def create_backend(name=None, path=None):
+    """
+    Create a shared state backend
+
+    Parameters:
+    name (str, optional): 'memory' or 'sqlite' (defaults to SHARED_STATE_BACKEND, then 'memory')
+    path (str, optional): SQLite file for the sqlite backend (defaults to SHARED_STATE_PATH)
+
+    Returns:
+    MemoryBackend or SQLiteBackend
+    """
+    name = (name or os.getenv('SHARED_STATE_BACKEND', 'memory')).lower()
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'sqlite':
+        return SQLiteBackend(path or os.getenv('SHARED_STATE_PATH', 'shared_state.db'))
+    raise ValueError(f"Unknown shared state backend: {name}")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Return the process-wide backend, creating it from the environment on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend()
+    return _backend
+
+
+def set_backend(backend):
+    """Replace the process-wide backend (used by wsgi.prepare_app)."""
+    global _backend
+    _backend = backend
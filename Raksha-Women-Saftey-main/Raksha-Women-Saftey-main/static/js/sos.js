@@ -195,6 +195,12 @@ function updateLocationStatus(position) {
     
     document.getElementById('locationStatus').innerHTML = 
         `<span class="text-success">Location available</span>`;
+    
+    // While an SOS is waiting to be sent, keep a trail of where the user went
+    if (hasQueuedSOS() && Date.now() - lastQueuedLocation >= SYNC_LOCATION_INTERVAL_MS) {
+        lastQueuedLocation = Date.now();
+        queueSyncEvent('l', latitude, longitude);
+    }
 }
 
 function handleLocationError(error) {
@@ -277,25 +283,13 @@ function confirmSOS() {
     sosButton.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Sending...';
     sosButton.disabled = true;
     
-    fetch('/sos', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-            latitude: window.currentLocation.lat,
-            longitude: window.currentLocation.lng
-        })
-    })
-    .then(response => {
-        if (!response.ok) {
-            throw new Error('Network response was not ok');
-        }
-        return response.json();
-    })
+    // Queue the SOS first so it survives a failed request or a closed tab
+    const seq = queueSyncEvent('s', window.currentLocation.lat, window.currentLocation.lng);
+    
+    syncUntilAcked(seq)
     .then(data => {
-        if (data.error) {
-            alert('Error: ' + data.error);
+        if (!sosDelivered(data)) {
+            alert('Error: ' + sosFailureMessage(data));
             sosButton.innerHTML = '<i class="fas fa-exclamation-triangle"></i> SOS';
         } else {
             alert('SOS alert sent successfully! Your emergency contacts have been notified.');
@@ -309,8 +303,11 @@ function confirmSOS() {
     })
     .catch(error => {
         console.error('Error sending SOS:', error);
-        alert('Failed to send SOS alert: ' + error.message);
-        sosButton.innerHTML = originalText;
+        alert('You appear to be offline. Your SOS has been saved and will be sent automatically as soon as your connection returns.');
+        sosButton.innerHTML = '<i class="fas fa-clock"></i> Queued';
+        setTimeout(() => {
+            sosButton.innerHTML = originalText;
+        }, 3000);
     })
     .finally(() => {
         sosButton.disabled = false;
@@ -318,4 +315,146 @@ function confirmSOS() {
             window.sirenSound.stop();
         }
     });
-} 
\ No newline at end of file
+}
+
+// Offline queue: SOS presses (and, while one is waiting, location fixes) are kept
+// in localStorage and sent in one batch to /api/sync. Each event has a per-device
+// sequence number; the server acknowledges up to a number and the client drops
+// everything up to it, so re-sending after a failure never duplicates an event.
+const SYNC_QUEUE_KEY = 'raksha.syncQueue';
+const SYNC_SEQ_KEY = 'raksha.syncSeq';
+const SYNC_DEVICE_KEY = 'raksha.syncDevice';
+const SYNC_RETRY_MS = 30000;
+const SYNC_LOCATION_INTERVAL_MS = 60000;
+const SYNC_MAX_ATTEMPTS = 5;
+const SYNC_LOGIN_MESSAGE = 'Your session has expired. Please log in again: your SOS is saved on this device and will be sent once you do.';
+let syncInFlight = null;
+let syncInFlightSeq = 0;
+let lastQueuedLocation = 0;
+
+function syncDeviceId() {
+    let device = localStorage.getItem(SYNC_DEVICE_KEY);
+    if (!device) {
+        device = Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+        localStorage.setItem(SYNC_DEVICE_KEY, device);
+    }
+    return device;
+}
+
+function loadSyncQueue() {
+    try {
+        return JSON.parse(localStorage.getItem(SYNC_QUEUE_KEY)) || [];
+    } catch (e) {
+        return [];
+    }
+}
+
+function queueSyncEvent(type, latitude, longitude) {
+    const seq = (parseInt(localStorage.getItem(SYNC_SEQ_KEY), 10) || 0) + 1;
+    localStorage.setItem(SYNC_SEQ_KEY, seq);
+    const queue = loadSyncQueue();
+    queue.push([seq, type, Date.now(), latitude, longitude]);
+    localStorage.setItem(SYNC_QUEUE_KEY, JSON.stringify(queue));
+    return seq;
+}
+
+function hasQueuedSOS() {
+    return loadSyncQueue().some(event => event[1] === 's');
+}
+
+// Send everything queued. Resolves with the server's reply, rejects if the network is down.
+// An expired session resolves with { error, login: true } rather than looking like an outage.
+function flushSyncQueue() {
+    const queue = loadSyncQueue();
+    if (syncInFlight) {
+        if (queue.some(event => event[0] > syncInFlightSeq)) {
+            // The request in flight was built before these events were queued; send them after it
+            return syncInFlight.catch(() => {}).then(flushSyncQueue);
+        }
+        return syncInFlight;
+    }
+    if (!queue.length) {
+        return Promise.resolve({ ack: 0 });
+    }
+
+    syncInFlightSeq = queue[queue.length - 1][0];
+    syncInFlight = fetch('/api/sync', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ device: syncDeviceId(), events: queue }),
+        // A logged-out request is redirected to the login page; see it rather than follow it
+        redirect: 'manual'
+    })
+    .then(response => {
+        const contentType = response.headers.get('Content-Type') || '';
+        if (response.type === 'opaqueredirect' || response.status === 401 || response.status === 302 ||
+                (response.ok && contentType.includes('text/html'))) {
+            return { error: SYNC_LOGIN_MESSAGE, login: true };
+        }
+        if (!contentType.includes('application/json')) {
+            return { error: 'Network response was not ok' };
+        }
+        return response.json().then(data => {
+            if (typeof data.ack === 'number') {
+                // Events may have been queued while the request was in flight, so re-read the queue
+                localStorage.setItem(SYNC_QUEUE_KEY, JSON.stringify(
+                    loadSyncQueue().filter(event => event[0] > data.ack)
+                ));
+            }
+            if (!response.ok && response.status !== 409) {
+                data.error = data.error || 'Network response was not ok';
+            }
+            return data;
+        });
+    })
+    .finally(() => {
+        syncInFlight = null;
+    });
+    return syncInFlight;
+}
+
+// Flush until the server has acknowledged event `seq`, and resolve with that reply
+function syncUntilAcked(seq, attempt = 1) {
+    return flushSyncQueue().then(data => {
+        if (data.error || (typeof data.ack === 'number' && data.ack >= seq) || attempt >= SYNC_MAX_ATTEMPTS) {
+            return data;
+        }
+        return syncUntilAcked(seq, attempt + 1);
+    });
+}
+
+// Only a reply that recorded the SOS and reached a contact counts as sent
+function sosDelivered(data) {
+    return Boolean(data.emergency_id) && data.alerts_sent === true;
+}
+
+function sosFailureMessage(data) {
+    return data.error || 'Your SOS was recorded, but we could not confirm that your emergency contacts were notified. Please call emergency services.';
+}
+
+function retrySyncQueue() {
+    if (loadSyncQueue().length && navigator.onLine !== false) {
+        flushSyncQueue()
+        .then(data => {
+            if (data.emergency_id || (data.login && hasQueuedSOS())) {
+                showQueuedSOSSent(data);
+            }
+        })
+        .catch(error => console.error('Queued events not sent yet:', error));
+    }
+}
+
+function showQueuedSOSSent(data) {
+    const locationStatus = document.getElementById('locationStatus');
+    if (locationStatus) {
+        locationStatus.innerHTML = sosDelivered(data)
+            ? '<span class="text-success">Your queued SOS alert has been sent.</span>'
+            : '<span class="text-danger">' + sosFailureMessage(data) + '</span>';
+    }
+}
+
+window.addEventListener('online', retrySyncQueue);
+document.addEventListener('DOMContentLoaded', retrySyncQueue);
+setInterval(retrySyncQueue, SYNC_RETRY_MS);
\ No newline at end of file
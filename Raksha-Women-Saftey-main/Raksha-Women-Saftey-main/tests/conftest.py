@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules live next to the tests directory, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shared_state
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    """A fresh in-memory shared state backend for the test"""
+    memory = shared_state.MemoryBackend()
+    monkeypatch.setattr(shared_state, '_backend', memory)
+    return memory
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,60 @@
+import sqlite3
+import threading
+import time
+
+import backup
+
+
+def make_database(path, rows=2000):
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute("CREATE TABLE emergency_history (id INTEGER PRIMARY KEY, location_name TEXT)")
+    conn.executemany("INSERT INTO emergency_history (location_name) VALUES (?)", [('x' * 200,)] * rows)
+    conn.commit()
+    conn.close()
+
+
+def row_count(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM emergency_history').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_idle_database_is_copied_in_steps(tmp_path):
+    source, dest = str(tmp_path / 'source.db'), str(tmp_path / 'copy.db')
+    make_database(source)
+
+    copy = backup.online_backup(source, dest, pages=16, sleep=0)
+
+    assert copy['method'] == 'stepped' and copy['restarts'] == 0
+    assert backup.integrity_check(dest) == 'ok'
+    assert row_count(dest) == 2000
+
+
+def test_copy_restarted_by_writes_falls_back_to_one_snapshot(tmp_path):
+    source, dest = str(tmp_path / 'source.db'), str(tmp_path / 'copy.db')
+    make_database(source)
+    writing = threading.Event()
+    writing.set()
+
+    def app_writes():
+        conn = sqlite3.connect(source, timeout=30)
+        while writing.is_set():
+            conn.execute("INSERT INTO emergency_history (location_name) VALUES ('sos')")
+            conn.commit()
+            time.sleep(0.001)
+        conn.close()
+
+    writer = threading.Thread(target=app_writes)
+    writer.start()
+    try:
+        copy = backup.online_backup(source, dest, pages=4, sleep=0.01, max_restarts=2)
+    finally:
+        writing.clear()
+        writer.join()
+
+    assert copy['method'] == 'vacuum' and copy['restarts'] == 3
+    assert backup.integrity_check(dest) == 'ok'
+    assert row_count(dest) >= 2000
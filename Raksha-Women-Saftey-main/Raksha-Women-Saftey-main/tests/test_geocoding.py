@@ -0,0 +1,86 @@
+import sqlite3
+import threading
+import time
+
+import shared_state
+from geocoding import FakeGeocoder, GeocodingService
+
+
+class RecordingGeocoder(FakeGeocoder):
+    """FakeGeocoder that also remembers which cells it was asked for"""
+
+    def __init__(self, latency=0.1):
+        super().__init__(latency)
+        self.queries = []
+
+    def reverse(self, query):
+        self.queries.append(query)
+        return super().reverse(query)
+
+
+def make_service(geocoder):
+    return GeocodingService(geocoder, rate=1000, backend=shared_state.MemoryBackend())
+
+
+def lookup_all(service, lookups):
+    """Run (latitude, longitude, priority) lookups on their own threads, started in order"""
+    results = [None] * len(lookups)
+
+    def lookup(index, latitude, longitude, priority):
+        results[index] = service.reverse(latitude, longitude, priority)
+
+    threads = []
+    for index, (latitude, longitude, priority) in enumerate(lookups):
+        thread = threading.Thread(target=lookup, args=(index, latitude, longitude, priority))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_lookups_of_one_cell_share_a_call():
+    geocoder = RecordingGeocoder(latency=0.3)
+    service = make_service(geocoder)
+
+    results = lookup_all(service, [(12.97161, 77.5946, 'share')] * 5)
+
+    assert len(geocoder.calls) == 1
+    assert service.stats['collapsed'] == 4
+    assert len(set(results)) == 1 and results[0].startswith('Fake address')
+    # Later lookups are answered from the cache
+    assert service.reverse(12.97159, 77.5946) == results[0]
+    assert len(geocoder.calls) == 1
+
+
+def test_sos_lookups_go_before_queued_shares():
+    geocoder = RecordingGeocoder(latency=0.3)
+    service = make_service(geocoder)
+
+    # The first lookup keeps the worker busy while the rest queue up behind it
+    lookup_all(service, [
+        (10.0, 70.0, 'share'),
+        (11.0, 70.0, 'share'),
+        (12.0, 70.0, 'share'),
+        (13.0, 70.0, 'sos'),
+    ])
+
+    assert geocoder.queries == ['10.0, 70.0', '13.0, 70.0', '11.0, 70.0', '12.0, 70.0']
+
+
+def test_worker_survives_shared_state_errors():
+    class LockedOnce(shared_state.MemoryBackend):
+        failed = False
+
+        def set(self, key, value, ttl=None):
+            if not self.failed:
+                self.failed = True
+                raise sqlite3.OperationalError('database is locked')
+            return super().set(key, value, ttl)
+
+    service = GeocodingService(RecordingGeocoder(latency=0), rate=1000, backend=LockedOnce())
+
+    assert service.reverse(10.0, 70.0, 'sos') == 'Coordinates: 10.0, 70.0'
+    assert service.stats['errors'] == 1
+    assert service.reverse(11.0, 70.0, 'sos').startswith('Fake address')
@@ -0,0 +1,43 @@
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, func, select
+
+from group_commit import GroupCommitWriter
+
+metadata = MetaData()
+location = Table(
+    'location', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('address', String(200))
+)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'group_commit.db'}")
+    metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def row_count(engine):
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(location)).scalar()
+
+
+def test_rows_are_committed_before_write_returns(engine):
+    writer = GroupCommitWriter(engine, delay=0.01)
+    writer.write(location, {'address': 'a'})
+    assert row_count(engine) == 1
+    writer.close()
+
+
+def test_timed_out_row_is_never_written(engine):
+    # A long batching window keeps the row waiting in the writer's queue
+    writer = GroupCommitWriter(engine, delay=0.5)
+    with pytest.raises(TimeoutError):
+        writer.write(location, {'address': 'late'}, timeout=0.05)
+    writer.write(location, {'address': 'retried'})
+    writer.close()
+
+    with engine.connect() as conn:
+        assert [row.address for row in conn.execute(select(location.c.address))] == ['retried']
@@ -0,0 +1,94 @@
+import pytest
+from flask import Flask, jsonify
+from flask_login import LoginManager, UserMixin, login_user
+
+import rate_limit
+from rate_limit import take_token, rate_limited
+
+
+@pytest.fixture
+def frozen(monkeypatch, clock):
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    return clock
+
+
+def test_bucket_allows_a_burst_up_to_capacity(backend, frozen):
+    results = [take_token('b', rate=1, capacity=3, backend=backend)[0] for _ in range(4)]
+    assert results == [True, True, True, False]
+
+
+def test_denial_reports_time_until_next_token(backend, frozen):
+    for _ in range(2):
+        take_token('b', rate=0.5, capacity=2, backend=backend)
+    allowed, retry_after = take_token('b', rate=0.5, capacity=2, backend=backend)
+    assert not allowed
+    assert retry_after == pytest.approx(2.0)
+
+
+def test_tokens_refill_over_time_but_not_past_capacity(backend, frozen):
+    for _ in range(2):
+        take_token('b', rate=1, capacity=2, backend=backend)
+    frozen.advance(1)
+    assert take_token('b', rate=1, capacity=2, backend=backend)[0]
+    assert not take_token('b', rate=1, capacity=2, backend=backend)[0]
+
+    frozen.advance(100)
+    results = [take_token('b', rate=1, capacity=2, backend=backend)[0] for _ in range(3)]
+    assert results == [True, True, False]
+
+
+class User(UserMixin):
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+@pytest.fixture
+def client(backend, frozen):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    login_manager = LoginManager(app)
+    login_manager.user_loader(User)
+
+    @app.route('/login/<user_id>')
+    def login(user_id):
+        login_user(User(user_id))
+        return 'ok'
+
+    @app.route('/limited')
+    @rate_limited('limited', per_user=(2, 60), per_route=(3, 60))
+    def limited():
+        return jsonify({'ok': True})
+
+    @app.route('/sos')
+    @rate_limited('sos', per_user=(1, 60), first_sos_exempt=True)
+    def sos():
+        return jsonify({'ok': True})
+
+    def client_for(user_id):
+        client = app.test_client()
+        client.get(f'/login/{user_id}')
+        return client
+    return client_for
+
+
+def test_per_user_limit(client):
+    alice = client('alice')
+    assert [alice.get('/limited').status_code for _ in range(3)] == [200, 200, 429]
+
+
+def test_route_denial_refunds_the_user_token(client, backend):
+    alice, bob = client('alice'), client('bob')
+    assert alice.get('/limited').status_code == 200
+    assert bob.get('/limited').status_code == 200
+    assert bob.get('/limited').status_code == 200
+    # The route bucket (3) is empty now, so alice is denied without spending her own quota
+    response = alice.get('/limited')
+    assert response.status_code == 429
+    assert response.headers['Retry-After']
+    tokens, _ = backend.get('rl:user:limited:alice')
+    assert tokens == pytest.approx(1)
+
+
+def test_first_sos_is_exempt(client):
+    alice = client('alice')
+    assert [alice.get('/sos').status_code for _ in range(3)] == [200, 200, 429]
@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, event, select
+
+import sharding
+
+metadata = MetaData()
+contact = Table(
+    'contact', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('user_id', Integer, nullable=False)
+)
+
+
+@pytest.fixture
+def shards(tmp_path):
+    engines = []
+    for n in range(2):
+        engine = create_engine(f"sqlite:///{tmp_path / f'shard{n}.db'}", connect_args={'timeout': 5})
+        metadata.create_all(engine)
+        engines.append(engine)
+    yield engines
+    for engine in engines:
+        engine.dispose()
+
+
+def names(engine, user_id):
+    with engine.connect() as conn:
+        return sorted(row.name for row in conn.execute(select(contact.c.name).where(contact.c.user_id == user_id)))
+
+
+def test_copy_user_moves_only_that_user(shards, backend):
+    source, dest = shards
+    with source.begin() as conn:
+        conn.execute(contact.insert(), [{'name': 'a', 'user_id': 1}, {'name': 'b', 'user_id': 1}, {'name': 'c', 'user_id': 2}])
+
+    assert sharding._copy_user(source, dest, 1) == 2
+    assert names(source, 1) == [] and names(dest, 1) == ['a', 'b']
+    assert names(source, 2) == ['c']
+
+
+def test_rows_written_during_a_move_are_kept(shards, backend):
+    source, dest = shards
+    with source.begin() as conn:
+        conn.execute(contact.insert(), {'name': 'copied', 'user_id': 1})
+
+    def live_write():
+        with source.begin() as conn:
+            conn.execute(contact.insert(), {'name': 'written during the move', 'user_id': 1})
+
+    writer = threading.Thread(target=live_write)
+
+    @event.listens_for(dest, 'commit')
+    def app_writes_between_copy_and_delete(conn):
+        writer.start()
+        writer.join(0.5)
+
+    sharding._copy_user(source, dest, 1)
+    writer.join()
+
+    assert names(dest, 1) == ['copied']
+    # The write waited for the move and was not deleted with the copied rows
+    assert names(source, 1) == ['written during the move']
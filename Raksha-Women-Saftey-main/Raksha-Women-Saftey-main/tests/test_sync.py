@@ -0,0 +1,87 @@
+import pytest
+
+import sharding
+
+
+@pytest.fixture(scope='module')
+def appmod(tmp_path_factory):
+    """The app on a scratch database (the engine is created lazily, so the URI can still be swapped)"""
+    pytest.importorskip('twilio')
+    monkeypatch = pytest.MonkeyPatch()
+    monkeypatch.setenv('TWILIO_ACCOUNT_SID', 'ACtest')
+    monkeypatch.setenv('TWILIO_AUTH_TOKEN', 'test')
+    import app as appmod
+    path = tmp_path_factory.mktemp('sync') / 'women_safety.db'
+    appmod.app.config.update(TESTING=True, SQLALCHEMY_DATABASE_URI=f"sqlite:///{path}")
+    with appmod.app.app_context():
+        sharding.create_all(appmod.db)
+        user = appmod.User(username='sync', email='sync@example.com', phone='1')
+        user.set_password('secret')
+        appmod.db.session.add(user)
+        appmod.db.session.commit()
+    yield appmod
+    monkeypatch.undo()
+
+
+@pytest.fixture
+def client(appmod, backend, monkeypatch):
+    monkeypatch.setattr(appmod, 'reverse_geocode', lambda latitude, longitude, *args, **kwargs: 'Test address')
+    monkeypatch.setattr(appmod, 'deliver_sos', lambda *args, **kwargs: {'success': True})
+    client = appmod.app.test_client()
+    client.post('/login', data={'username': 'sync', 'password': 'secret'})
+    return client
+
+
+def location_count(appmod):
+    with appmod.app.app_context():
+        return appmod.Location.query.count()
+
+
+def test_resent_batch_is_applied_once(appmod, client):
+    before = location_count(appmod)
+    batch = {'device': 'resend', 'events': [[1, 'l', 0, 12.97, 77.59], [2, 'l', 0, 12.98, 77.59]]}
+
+    first = client.post('/api/sync', json=batch)
+    assert first.status_code == 200 and first.get_json() == {'ack': 2}
+    assert location_count(appmod) == before + 2
+
+    again = client.post('/api/sync', json=batch)
+    assert again.status_code == 200 and again.get_json() == {'ack': 2}
+    assert location_count(appmod) == before + 2
+
+    # Only the new event of an overlapping batch is applied
+    batch['events'].append([3, 'l', 0, 12.99, 77.59])
+    assert client.post('/api/sync', json=batch).get_json() == {'ack': 3}
+    assert location_count(appmod) == before + 3
+
+
+def test_malformed_events_are_counted_and_acked(appmod, client):
+    response = client.post('/api/sync', json={'device': 'malformed', 'events': [
+        [1, 'l', 0, 12.97, 77.59],
+        [2, 'x', 0, 12.97, 77.59],
+        [3, 'l', 0],
+        ['4', 'l', 0, 12.97, 77.59],
+    ]})
+    assert response.status_code == 200
+    # Seqs 2 and 3 are readable, so they are acknowledged and never re-sent; '4' can't be
+    assert response.get_json() == {'ack': 3, 'rejected': 3}
+
+
+def test_cursor_moved_by_another_request_gives_409(appmod, client, monkeypatch):
+    assert client.post('/api/sync', json={'device': 'race', 'events': [[1, 'l', 0, 12.97, 77.59]]}).status_code == 200
+    before = location_count(appmod)
+
+    def overlapping_request(latitude, longitude, *args, **kwargs):
+        # Another request from the same device commits while this one is still working
+        with appmod.db.engine.begin() as conn:
+            conn.execute(appmod.SyncCursor.__table__.update()
+                         .where(appmod.SyncCursor.device == 'race').values(seq=5))
+        return 'Test address'
+
+    monkeypatch.setattr(appmod, 'reverse_geocode', overlapping_request)
+    response = client.post('/api/sync', json={'device': 'race', 'events': [
+        [2, 'l', 0, 12.97, 77.59], [3, 's', 0, 12.97, 77.59]
+    ]})
+    assert response.status_code == 409
+    assert response.get_json() == {'ack': 5}
+    assert location_count(appmod) == before
@@ -0,0 +1,47 @@
+"""
+Production WSGI entry point
+
+Run with gunicorn using the bundled config:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+`python app.py` is still the single-process development server.
+`python loadtest.py` measures throughput under gunicorn at several worker counts.
+"""
+
+import os
+from app import app as flask_app, db
+import shared_state
+import sharding
+
+
+def prepare_app(shared_state_backend=None):
+    """
+    Prepare the app module's Flask app for running under several worker processes.
+    There is only one app per process (app.py builds it at import time), so this
+    configures that app in place rather than building a new one.
+
+    Parameters:
+    shared_state_backend (str, optional): Backend for caches, dedup windows and
+        rate limits. Defaults to SHARED_STATE_BACKEND, then 'sqlite' so that
+        every worker sees the same state.
+
+    Returns:
+    Flask: The application from app.py
+    """
+    backend_name = shared_state_backend or os.getenv('SHARED_STATE_BACKEND', 'sqlite')
+    shared_state.set_backend(shared_state.create_backend(backend_name))
+
+    with flask_app.app_context():
+        sharding.create_all(db)
+        for engine in sharding.engines(db):
+            if engine.url.drivername.startswith('sqlite'):
+                # WAL lets readers in other workers proceed while one worker writes.
+                # The journal mode is stored in the database file, so once is enough.
+                with engine.connect() as conn:
+                    conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+
+    return flask_app
+
+
+app = prepare_app()